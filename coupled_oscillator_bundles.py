@@ -12,6 +12,7 @@ import random
 import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
+from utils import *
 
 matplotlib.rcParams['text.usetex'] = True
 
@@ -28,10 +29,14 @@ parser.add_argument('--test_freq', type=int, default=200)
 parser.add_argument('--viz', action='store_false')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--chain_masses', type=int, default=100)
+parser.add_argument('--n_windows', type=int, default=1, help='also propagate the ICs over this many consecutive basis windows')
+add_runtime_args(parser)
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 scaler = MinMaxScaler()
 
-torch.set_default_tensor_type('torch.DoubleTensor')
 
 # print(args.evaluate_only==False)
 
@@ -43,7 +48,7 @@ class diffeq(nn.Module):
     def __init__(self):
         super().__init__()
         # self.a1 = a1
-        self.Amatrix = torch.tensor([[0,1],[-1,0]])
+        self.Amatrix = rt.tensor([[0,1],[-1,0]])
     # return ydot
     def forward(self, t, y):
         return get_udot(y)
@@ -54,8 +59,8 @@ def get_udot(y):
     # return yd.t()
     m1,m2 = 1.,1.
     k1,k2 = 2.,4.
-    Lmat = torch.tensor([[m1, 0.], [0., m2]])
-    Rmat = torch.tensor([[k1 + k2, -k2], [-k2, k1 + k2]])
+    Lmat = rt.tensor([[m1, 0.], [0., m2]])
+    Rmat = rt.tensor([[k1 + k2, -k2], [-k2, k1 + k2]])
     Amatrix = Rmat
     yd = -Amatrix @ y.t()
     return yd.t()
@@ -91,31 +96,117 @@ class ODEFunc(nn.Module):
         return x
 
 
-def get_wout(s, sd,sdd, y0,y0dot,m1,m2,k1,k2, t):
-
+def get_lhs(s, sd, sdd, m1, m2, k1, k2):
+    """
+    normal matrix of the two-mass system and the stacked IC rows it was built with
 
-    Lmat = torch.tensor([[m1, 0.], [0., m2]])
-    Rmat = torch.tensor([[k1 + k2, -k2], [-k2, k1 + k2]])
+    DH = I (x) sdd + (A (x) I) (I (x) s) is kept as Kron terms so the 2N x 2N mixing matrix A (x) I is
+    never formed; gram densifies the sum to its 2N x 2H rows for DH^T DH
+    """
+    Lmat = rt.tensor([[m1, 0.], [0., m2]])
+    Rmat = rt.tensor([[k1 + k2, -k2], [-k2, k1 + k2]])
     Amatrix = torch.linalg.inv(Lmat)@Rmat
-    hddothat = torch.block_diag(sdd,sdd)
-    hdothat = torch.block_diag(sd,sd)
-    hhat = torch.block_diag(s,s)
-    Amatrixhat = torch.zeros((hdothat.shape[0],hdothat.shape[0]))
-    for i in range(Amatrix.shape[0]):
-        for j in range(Amatrix.shape[1]):
-            Amatrixhat[i*s.shape[0]:(i+1)*s.shape[0],j*s.shape[0]:(j+1)*s.shape[0]]=torch.eye(s.shape[0],s.shape[0])*Amatrix[i,j]
+    I2 = rt.eye(2)
+    Amatrixhat = Kron(Amatrix, ScaledIdentity(len(s), dtype=rt.dtype, device=rt.device))
 
-    DH = hddothat + Amatrixhat@hhat
+    DH = Kron(I2, sdd) + Amatrixhat@Kron(I2, s)
 
+    h0 = Kron(I2, s[:1])
 
-    h0= torch.block_diag(s[0,:].reshape(1,-1),s[0,:].reshape(1,-1))
+    h0dot = Kron(I2, sd[:1])
 
-    h0dot = torch.block_diag(sd[0, :].reshape(1, -1), sd[0, :].reshape(1, -1))
+    return gram(DH) + gram(h0) + gram(h0dot), h0, h0dot
+
+
+def get_wout(s, sd,sdd, y0,y0dot,m1,m2,k1,k2, t):
 
-    W0 = torch.linalg.solve(DH.t()@DH + h0.t()@h0 + h0dot.t()@h0dot, h0.t()@y0.t() + h0dot.t()@y0dot.t() )
+    LHS, h0, h0dot = get_lhs(s, sd, sdd, m1, m2, k1, k2)
+    W0 = LinearSolver(LHS).solve(h0.t()@y0.t() + h0dot.t()@y0dot.t() )
     return W0
 
 
+def get_wout_batch(s, sd, sdd, y0s, y0dots, m1, m2, k1, k2):
+    """
+    Wouts (2H x B) for a batch of initial conditions y0s, y0dots (B x 2) of one fixed system:
+    the LHS does not depend on the ICs, so it is factored once and all ICs are one multi-RHS solve
+    """
+    LHS, h0, h0dot = get_lhs(s, sd, sdd, m1, m2, k1, k2)
+    return LinearSolver(LHS).solve(h0.t() @ y0s.t() + h0dot.t() @ y0dots.t())
+
+
+def get_windowed_trajectory(s, sd, sdd, y0s, y0dots, m1, m2, k1, k2, n_windows):
+    """
+    y, y' (T x B x 2) of a batch of ICs over n_windows consecutive copies of the basis window (see chain_windows)
+
+    the system is time invariant, so every window is the same least-squares problem started from the
+    previous window's end value and velocity: the LHS is factored once and each window is one multi-RHS solve
+    """
+    LHS, h0, h0dot = get_lhs(s, sd, sdd, m1, m2, k1, k2)
+    solver = LinearSolver(LHS)
+    n = s.shape[1]
+
+    def window(state):
+        W = solver.solve(h0.t() @ state[0].t() + h0dot.t() @ state[1].t())
+        y = torch.stack([s @ W[:n], s @ W[n:]], 2)
+        yd = torch.stack([sd @ W[:n], sd @ W[n:]], 2)
+        return (y, yd), (y[-1], yd[-1])
+
+    return chain_windows(window, (y0s, y0dots), n_windows)
+
+
+def get_exact_trajectory(t, y0s, y0dots, m1, m2, k1, k2):
+    """
+    exact y (T x B x 2) of the two-mass system from its normal modes, for y0s, y0dots (B x 2)
+    """
+    m_half = torch.stack([m1, m2]).sqrt()
+    K = rt.tensor([[k1 + k2, -k2], [-k2, k1 + k2]])
+    lam, Q = torch.linalg.eigh(K / m_half.reshape(-1, 1) / m_half.reshape(1, -1))
+    omega = lam.sqrt()
+    z0, z0dot = (y0s * m_half) @ Q, (y0dots * m_half) @ Q
+    wt = t.reshape(-1, 1, 1) * omega
+    z = torch.cos(wt) * z0 + torch.sin(wt) / omega * z0dot
+    return (z @ Q.t()) / m_half
+
+
+def get_chain_stiffness(springs):
+    """
+    sparse stiffness matrix of n masses chained between two walls by the n+1 spring constants in springs
+    """
+    n = len(springs) - 1
+    i = rt.arange(n, dtype=torch.long)
+    off = -springs[1:-1]
+    indices = torch.cat([torch.stack([i, i]), torch.stack([i[:-1], i[1:]]), torch.stack([i[1:], i[:-1]])], 1)
+    values = torch.cat([springs[:-1] + springs[1:], off, off])
+    return torch.sparse_coo_tensor(indices, values, (n, n)).coalesce()
+
+
+def get_wout_modal(s, sd, sdd, y0, y0dot, masses, K):
+    """
+    Wout (H x n) for M y'' + K y = 0 with M = diag(masses) and a symmetric, possibly sparse, stiffness K
+
+    M^-1/2 K M^-1/2 = Q diag(lam) Q^T is diagonalized once. In the mass-weighted coordinates
+    X = W M^1/2 Q the residual becomes sdd X + s X diag(lam), so the least-squares problem splits into
+    n independent H-sized solves that share the Grams of s and sdd. For unit masses this is exactly
+    the get_wout objective; otherwise residuals and ICs are weighted by M^1/2.
+    """
+    if K.is_sparse:
+        K = K.to_dense()
+    m_half = masses.sqrt()
+    lam, Q = torch.linalg.eigh(K / m_half.reshape(-1, 1) / m_half.reshape(1, -1))
+    z0 = (y0.reshape(1, -1) * m_half) @ Q
+    z0dot = (y0dot.reshape(1, -1) * m_half) @ Q
+
+    SS, SddS, SddSdd = s.t() @ s, sdd.t() @ s, sdd.t() @ sdd
+    h0 = s[0, :].reshape(-1, 1)
+    h0dot = sd[0, :].reshape(-1, 1)
+    lam = lam.reshape(-1, 1, 1)
+    LHS = SddSdd + lam * (SddS + SddS.t()) + lam ** 2 * SS + h0 @ h0.t() + h0dot @ h0dot.t()
+    RHS = h0 * z0.reshape(-1, 1, 1) + h0dot * z0dot.reshape(-1, 1, 1)
+
+    X = LinearSolver(LHS).solve(RHS)
+    return (X[:, :, 0].t() @ Q.t()) / m_half
+
+
 
 if args.viz:
 
@@ -149,38 +240,46 @@ def visualize(pred_y,pred_yd, lst):
         plt.pause(0.001)
 
 
-def get_block_m(m1,m2):
-    Amatrix = []
+class BlockOperator:
+    """
+    block-diagonal operator built from n 2x2 blocks stored as a (n, 2, 2) tensor
 
-    # print(m1.shape)
-    m1 = m1.reshape(1,-1)
-    m2 = m2.reshape(1,-1)
-    # print(m1[0,0])
-    for i in range(m1.shape[1]):
-        Amatrix.append(torch.tensor([[m1[0,i].item(), 0.], [0., m2[0,i].item()]]))
+    op @ x for x of shape (2n, ...) gives torch.block_diag(*blocks) @ x with one einsum,
+    so applying it costs O(n) instead of the O(n^2) of the dense block matrix
+    """
 
-    # print(torch.block_diag(*Amatrix).shape)
-    return torch.block_diag(*Amatrix)
+    def __init__(self, blocks):
+        self.blocks = blocks
 
-def get_block_k(k1,k2):
-    Amatrix = []
+    def __matmul__(self, x):
+        assert x.shape[0] == 2 * len(self.blocks), f'expected {2 * len(self.blocks)} rows, got {tuple(x.shape)}'
+        out = torch.einsum('nij,njk->nik', self.blocks, x.reshape(len(self.blocks), 2, -1))
+        return out.reshape(x.shape)
 
-    k1 = k1.reshape(1,-1)
-    k2 = k2.reshape(1,-1)
-    for i in range(k1.shape[1]):
-        Amatrix.append(torch.tensor([[k1[0,i]+k2[0,i], -k2[0,i]], [-k2[0,i], k1[0,i]+k2[0,i]]]))
+    def to_dense(self):
+        return torch.block_diag(*self.blocks)
 
-    return torch.block_diag(*Amatrix)
+
+def get_block_m(m1,m2):
+    m1 = m1.reshape(-1)
+    m2 = m2.reshape(-1)
+    zero = torch.zeros_like(m1)
+    return BlockOperator(torch.stack([torch.stack([m1, zero], 1), torch.stack([zero, m2], 1)], 1))
+
+def get_block_k(k1,k2):
+    k1 = k1.reshape(-1)
+    k2 = k2.reshape(-1)
+    return BlockOperator(torch.stack([torch.stack([k1 + k2, -k2], 1), torch.stack([-k2, k1 + k2], 1)], 1))
 
 
 
 def get_m(x_in,m1,m2):
-    Amatrix = torch.tensor([[m1, 0.], [0., m2]])
+    Amatrix = rt.tensor([[m1, 0.], [0., m2]])
     output = Amatrix @ x_in.t()
     return output.t()
 
 def get_k(x_in,k1,k2):
-    Amatrix = torch.tensor([[k1+k2, -k2], [-k2, k1+k2]])
+    Amatrix = rt.tensor([[k1+k2, -k2], [-k2, k1+k2]])
     output = Amatrix @ x_in.t()
     return output.t()
 
@@ -195,12 +294,12 @@ if __name__ == '__main__':
     r1 = -1.5
 
     #true_y0 = (r2 - r1) * torch.rand(2) + r1
-    true_y0 = (r2 - r1) * torch.rand(100,2) + r1#torch.tensor([1.,1.]).reshape(1,2)
-    true_y0dot = torch.zeros(100,2)#(r2 - r1) * torch.rand(100,2) + r1#torch.tensor([1., 3.]).reshape(1, 2)
-    k1s = torch.linspace(0.5, 4.5, 100)#torch.ones(100)*0.5
-    k2s = torch.linspace(.5, 4.5, 100)
-    m1s = torch.linspace(1, 2, 100)
-    m2s = torch.linspace(1, 2, 100)
+    true_y0 = (r2 - r1) * rt.rand(100,2) + r1#torch.tensor([1.,1.]).reshape(1,2)
+    true_y0dot = rt.zeros(100,2)#(r2 - r1) * torch.rand(100,2) + r1#torch.tensor([1., 3.]).reshape(1, 2)
+    k1s = rt.linspace(0.5, 4.5, 100)#torch.ones(100)*0.5
+    k2s = rt.linspace(.5, 4.5, 100)
+    m1s = rt.linspace(1, 2, 100)
+    m2s = rt.linspace(1, 2, 100)
 
     indices = random.choices(np.arange(100),k=args.num_bundles)
     # print(indices)
@@ -214,7 +313,7 @@ if __name__ == '__main__':
 
     # print(y0s,y0ds,k1sample,k2sample,m1sample,m2sample)
 
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
     Mblock = get_block_m(m1sample,m2sample)
@@ -222,7 +321,7 @@ if __name__ == '__main__':
 
 
     # instantiate wout with coefficients
-    func = ODEFunc(hidden_dim=NDIMZ, output_dim=2*args.num_bundles)
+    func = rt.module(ODEFunc(hidden_dim=NDIMZ, output_dim=2*args.num_bundles))
 
     optimizer = optim.Adam(func.parameters(), lr=1e-3)
 
@@ -236,9 +335,9 @@ if __name__ == '__main__':
             func.train()
 
             # add t0 to training times, including randomly generated ts
-            t0 = torch.tensor([[0.]])
+            t0 = rt.tensor([[0.]])
             t0.requires_grad = True
-            tv = args.tmax * torch.rand(int(args.tmax / args.dt))[:50].reshape(-1, 1)
+            tv = args.tmax * rt.rand(int(args.tmax / args.dt))[:50].reshape(-1, 1)
             tv.requires_grad = True
             tv = torch.cat([t0, tv], 0)
             optimizer.zero_grad()
@@ -286,29 +385,24 @@ if __name__ == '__main__':
     gt_generator = base_diffeq(diffeq_init)
 
 
-    func.load_state_dict(torch.load('func_ffnn_systems_coupled'))
+    func.load_state_dict(rt.load('func_ffnn_systems_coupled'))
     func.eval()
 
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
-    h = func.h(t)
-    hd = diff(h, t)
-    hdd = diff(hd,t)
-    h = h.detach()
-    hd = hd.detach()
-    hdd = hdd.detach()
+    h, hd, hdd = get_hidden_derivatives(func, (t,), [(0,), (0, 0)])
 
-    h = torch.cat([h,torch.ones(len(h),1)],1)
-    hd = torch.cat([hd, torch.zeros(len(h), 1)], 1)
-    hdd = torch.cat([hdd, torch.zeros(len(h), 1)], 1)
+    h = torch.cat([h,rt.ones(len(h),1)],1)
+    hd = torch.cat([hd, rt.zeros(len(h), 1)], 1)
+    hdd = torch.cat([hdd, rt.zeros(len(h), 1)], 1)
 
     s1 = time.time()
 
-    m1 = torch.tensor(1.)
-    m2 = torch.tensor(1.)
-    k1 = torch.tensor(2.)
-    k2 = torch.tensor(4.)
+    m1 = rt.tensor(1.)
+    m2 = rt.tensor(1.)
+    k1 = rt.tensor(2.)
+    k2 = rt.tensor(4.)
 
     r2 = 1.5
     r1 = -1.5
@@ -331,18 +425,19 @@ if __name__ == '__main__':
     pred_ys = []
     pred_yds = []
 
-    for i in range(50):
-        if i == 0:
-            true_y0 = torch.tensor([1.,0.]).reshape(1,2)#((r2 - r1) * torch.rand(2) + r1).reshape(1, 2)
-        else:
-            true_y0 = ((r2 - r1) * torch.rand(2) + r1).reshape(1,2)#torch.tensor([1., 1.]).reshape(1, 2)
-        true_y0dot =  torch.tensor([0.,0.]).reshape(1,2)#((r2 - r1) * torch.rand(2) + r1).reshape(1,2)#torch.tensor([1., 3.]).reshape(1, 2)
+    # draw all initial conditions first, the system is fixed so they share one factorization
+    true_y0s = [rt.tensor([1.,0.]).reshape(1,2)] + [((r2 - r1) * rt.rand(2) + r1).reshape(1,2) for _ in range(49)]
+    true_y0s = torch.cat(true_y0s)
+    true_y0dots = rt.zeros(50, 2)
 
+    with torch.no_grad():
+        s1 = time.time()
+        wouts = get_wout_batch(h, hd, hdd, true_y0s, true_y0dots, m1, m2, k1, k2)
+        print(f'wout batch of {len(true_y0s)}:{time.time()-s1}')
+
+    for i in range(50):
         with torch.no_grad():
-            s1 = time.time()
-            wout = get_wout(h, hd,hdd, true_y0,true_y0dot,m1,m2,k1,k2, t.detach())
-            print(time.time()-s1)
-            nwout = torch.cat([wout[:args.hidden_size+1,0].reshape(-1,1),wout[args.hidden_size+1:,0].reshape(-1,1)],1)
+            nwout = torch.cat([wouts[:args.hidden_size+1,i].reshape(-1,1),wouts[args.hidden_size+1:,i].reshape(-1,1)],1)
             pred_y = h @ nwout
             pred_yd = hd @ nwout
             pred_yddot = hdd @ nwout
@@ -355,6 +450,25 @@ if __name__ == '__main__':
     print('final loss mean')
     print(np.mean(losses),np.std(losses))
 
+    # same basis on a chain of masses between two walls, decoupled into its normal modes
+    chain_m = rt.linspace(1, 2, args.chain_masses)
+    chain_k = get_chain_stiffness(rt.linspace(0.5, 4.5, args.chain_masses + 1))
+    chain_y0 = (r2 - r1) * rt.rand(1, args.chain_masses) + r1
+    with torch.no_grad():
+        s1 = time.time()
+        wout = get_wout_modal(h, hd, hdd, chain_y0, torch.zeros_like(chain_y0), chain_m, chain_k)
+        print(f'chain of {args.chain_masses} masses:{time.time()-s1}')
+        loss_diffeq = (hdd @ wout) * chain_m + torch.sparse.mm(chain_k, (h @ wout).t()).t()
+        print(np.mean((loss_diffeq**2).mean(1).numpy()))
+
+    if args.n_windows > 1:
+        with torch.no_grad():
+            s1 = time.time()
+            (pred_y, pred_yd), _, jumps = get_windowed_trajectory(h, hd, hdd, true_y0s, true_y0dots, m1, m2, k1, k2, args.n_windows)
+            print(f'{args.n_windows} windows to t={(len(pred_y) - 1) * args.dt:.2f}:{time.time()-s1}')
+            exact_y = get_exact_trajectory(rt.arange(len(pred_y)) * args.dt, true_y0s, true_y0dots, m1, m2, k1, k2)
+            print(f'max jump:{max(jumps)} max error:{(pred_y - exact_y).abs().max().item()}')
+
     f, (a0) = plt.subplots(1,1, figsize=(6, 6))
 
     for i,(pred_y,pred_yd) in enumerate(zip(pred_ys,pred_yds)):
@@ -9,6 +9,7 @@ import numpy as np
 import time
 import seaborn as sns
 import matplotlib.pyplot as plt
+from utils import *
 
 parser = argparse.ArgumentParser('transfer demo')
 
@@ -25,12 +26,17 @@ parser.add_argument('--bs', type=int, default=100)
 parser.add_argument('--viz', action='store_true')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--num_lambdas', type=int, default=1000)
+parser.add_argument('--num_profiles', type=int, default=1000)
+parser.add_argument('--separable', action='store_true', help='hidden states h_t(t) * h_x(x), assembled on the grid by Kronecker structure')
+parser.add_argument('--grid_size', type=int, default=50, help='points per axis of the evaluation grid')
 
+add_runtime_args(parser, device='auto', dtype='float32')
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 
 
-torch.set_default_tensor_type('torch.cuda.FloatTensor')
-torch.backends.cudnn.benchmark = True
 
 
 class SiLU(nn.Module):
@@ -77,34 +83,6 @@ class ODEFunc(nn.Module):
     def wouts(self, x):
         return self.lout(x)
 
-def diff(u, t, order=1):
-    # code adapted from neurodiffeq library
-    # https://github.com/NeuroDiffGym/neurodiffeq/blob/master/neurodiffeq/neurodiffeq.py
-    r"""The derivative of a variable with respect to another.
-    While there's no requirement for shapes, errors could occur in some cases.
-    See `this issue <https://github.com/NeuroDiffGym/neurodiffeq/issues/63#issue-719436650>`_ for details
-    """
-    # ones = torch.ones_like(u)
-
-
-    der = torch.cat([torch.autograd.grad(u[:, i].sum(), t, create_graph=True)[0] for i in range(u.shape[1])],1)
-    if der is None:
-        print('derivative is None')
-        return torch.zeros_like(t, requires_grad=True)
-    else:
-        der.requires_grad_()
-    for _ in range(1, order):
-
-        der = torch.cat([torch.autograd.grad(der[:, i].sum(), t, create_graph=True)[0] for i in range(der.shape[1])],1)
-        # print()
-        if der is None:
-            print('derivative is None')
-            return torch.zeros_like(t, requires_grad=True)
-        else:
-            der.requires_grad_()
-    return der
-
-
 class Transformer_Learned(nn.Module):
     """
     returns Wout learnable, only need hidden and output dims
@@ -118,6 +96,29 @@ class Transformer_Learned(nn.Module):
         return self.lin1(x)
 
 
+class TransferOperator:
+    """
+    Wout of one diffusion coefficient as a fixed linear map of the IC samples F on grid_x[:, 0] and the
+    boundary data BL, BR on the time grid: W = LHS^-1 H0^T F + LHS^-1 [HL^T, HR^T] [BL; BR]
+
+    both projections are solved once (in float64) through a LambdaSweep, so a batch of profiles is one matmul
+    """
+
+    def __init__(self, sweep, lambda_val, H0, HL, HR):
+        proj = sweep.solve([lambda_val], torch.cat([H0, HL, HR]).t().double())[0]
+        self.ic_proj = proj[:, :len(H0)]
+        self.bc_proj = proj[:, len(H0):]
+
+    def __call__(self, F, BL=None, BR=None):
+        """
+        F (Nx, B) and optionally BL, BR (Nt, B) -> Wout (H, B)
+        """
+        W = self.ic_proj @ F.double()
+        if BL is not None:
+            W = W + self.bc_proj @ torch.cat([BL, BR]).double()
+        return W.to(F.dtype)
+
+
 class Transformer_Analytic(nn.Module):
     """
     returns Wout analytic, need to define the parameter coefficients
@@ -135,32 +136,28 @@ class Transformer_Analytic(nn.Module):
 
         # print('enter wout')
         # s1=time.time()
-        H = func.hidden_states(t,x)
-        # s2 = time.time()
-        # print(s2-s1)
-        dHdt = diff(H,t)
-        d2Hdx2 = diff(H,x,2)
+        H, dHdt, d2Hdx2 = get_hidden_derivatives(func, (t, x), [(0,), (1, 1)])
 
-        H = torch.cat([H, torch.ones(len(H), 1)], 1)
-        dHdt = torch.cat([dHdt, torch.zeros(len(H), 1)], 1)
-        d2Hdx2 = torch.cat([d2Hdx2, torch.zeros(len(H), 1)], 1)
+        H = torch.cat([H, rt.ones(len(H), 1)], 1)
+        dHdt = torch.cat([dHdt, rt.zeros(len(H), 1)], 1)
+        d2Hdx2 = torch.cat([d2Hdx2, rt.zeros(len(H), 1)], 1)
         # s2 = time.time()
         # print(s2-s1)
 
         DH = (dHdt-self.lambda_eqn*d2Hdx2)
 
         H0 = func.hidden_states(grid_t[:,0].reshape(-1,1),grid_x[:,0].reshape(-1,1))
-        H0 = torch.cat([H0,torch.ones(len(H0),1)],1)
+        H0 = torch.cat([H0,rt.ones(len(H0),1)],1)
         HL = func.hidden_states(grid_t[0,:].reshape(-1,1),grid_x[0,:].reshape(-1,1))
-        HL = torch.cat([HL, torch.ones(len(H0),1)],1)
+        HL = torch.cat([HL, rt.ones(len(H0),1)],1)
         HR = func.hidden_states(grid_t[-1, :].reshape(-1, 1), grid_x[-1, :].reshape(-1, 1))
-        HR = torch.cat([HR, torch.ones(len(H0),1)],1)
+        HR = torch.cat([HR, rt.ones(len(H0),1)],1)
 
         F = self.f(grid_x[:,0]).reshape(-1,1)
         BL = self.lbc(grid_t[0,:]).reshape(-1,1)
         BR = self.rbc(grid_t[0,:]).reshape(-1,1)
 
-        W0 = torch.linalg.solve(DH.t() @ DH  +H0.t()@H0 + HL.t()@HL+HR.t()@HR,H0.t()@F + HL.t()@BL + HR.t()@BR)
+        W0 = LinearSolver(DH.t() @ DH  +H0.t()@H0 + HL.t()@HL+HR.t()@HR).solve(H0.t()@F + HL.t()@BL + HR.t()@BR)
         return W0
 
 
@@ -205,13 +202,13 @@ if __name__ == '__main__':
     # training differential equation
 
     xl = 0
-    xr = torch.tensor(np.pi)
+    xr = rt.tensor(np.pi)
     t0 = 0
     tmax = args.tmax
 
 
-    x_evals = torch.linspace(xl,xr,100)
-    y_evals = torch.linspace(t0,tmax,100)
+    x_evals = rt.linspace(xl,xr,100)
+    y_evals = rt.linspace(t0,tmax,100)
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
     grid_x.requires_grad = True
     grid_t.requires_grad = True
@@ -223,10 +220,10 @@ if __name__ == '__main__':
 
 
     # left BC
-    bc_left = torch.ones(100)*xl
-    bc_right = torch.ones(100)*xr
+    bc_left = rt.ones(100)*xl
+    bc_right = rt.ones(100)*xr
     ic_t0 = torch.cat([torch.sin(x_evals).reshape(-1,1),torch.sin(2*x_evals).reshape(-1,1),torch.sin(3*x_evals).reshape(-1,1),torch.sin(4*x_evals).reshape(-1,1),torch.sin(5*x_evals).reshape(-1,1)],1)
-    lambda_0s = torch.tensor([1.,2.,3.,4.,5.]).reshape(1,-1)
+    lambda_0s = rt.tensor([1.,2.,3.,4.,5.]).reshape(1,-1)
 
 
     bc_left.requires_grad=True
@@ -234,7 +231,11 @@ if __name__ == '__main__':
     ic_t0.requires_grad=True
 
     # wout_gen = Transformer_Analytic()
-    func = ODEFunc(hidden_dim=NDIMZ,output_dim=args.num_bundles)
+    if args.separable:
+        func = rt.module(SeparableODEFunc(hidden_dim=NDIMZ,output_dim=args.num_bundles))
+    else:
+        func = rt.module(ODEFunc(hidden_dim=NDIMZ,output_dim=args.num_bundles))
+    checkpoint = 'func_ffnn_diffusion_separable' if args.separable else 'func_ffnn_diffusion'
 
     optimizer = optim.Adam(func.parameters(), lr=1e-3)
 
@@ -245,9 +246,9 @@ if __name__ == '__main__':
 
         for itr in range(1, args.niters + 1):
             func.train()
-            indices = torch.tensor(np.random.choice(len(grid_x),1000))
-            x_tr = (grid_x[indices]).reshape(-1,1) + 0.005*torch.rand(len(indices),1)
-            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*torch.rand(len(indices),1)
+            indices = rt.tensor(np.random.choice(len(grid_x),1000), dtype=torch.long)
+            x_tr = (grid_x[indices]).reshape(-1,1) + 0.005*rt.rand(len(indices),1)
+            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*rt.rand(len(indices),1)
 
             # add t0 to training times, including randomly generated ts
             optimizer.zero_grad()
@@ -260,7 +261,7 @@ if __name__ == '__main__':
             #enforce diffeq
             loss_diffeq = torch.mean((dudt - lambda_0s*d2udx2)**2)
 
-            u_t0 = torch.mean((func(torch.zeros(len(x_evals)).reshape(-1,1),x_evals.reshape(-1,1)) - ic_t0)**2)
+            u_t0 = torch.mean((func(rt.zeros(len(x_evals)).reshape(-1,1),x_evals.reshape(-1,1)) - ic_t0)**2)
             u_left = torch.mean((func(y_evals.reshape(-1,1),bc_left.reshape(-1,1)) - 0) ** 2)
             u_right = torch.mean((func(y_evals.reshape(-1, 1), bc_right.reshape(-1,1)) - 0) ** 2)
 
@@ -296,7 +297,7 @@ if __name__ == '__main__':
                 current_residual = loss_diffeq.item()
                 # print(current_residual)
                 if current_residual < best_residual:
-                    torch.save(func.state_dict(), 'func_ffnn_diffusion')
+                    torch.save(func.state_dict(), checkpoint)
                     best_residual = current_residual
                     print(itr, best_residual)
 
@@ -311,11 +312,11 @@ if __name__ == '__main__':
                         'lines.linewidth': 2})
     sns.set_palette('deep')
 
-    func.load_state_dict(torch.load('func_ffnn_diffusion'))
+    func.load_state_dict(rt.load(checkpoint))
     func.eval()
 
-    x_evals = torch.linspace(xl, xr, 50)
-    y_evals = torch.linspace(t0, tmax, 50)
+    x_evals = rt.linspace(xl, xr, args.grid_size)
+    y_evals = rt.linspace(t0, tmax, args.grid_size)
     x_evals.requires_grad = True
     y_evals.requires_grad = True
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
@@ -326,19 +327,29 @@ if __name__ == '__main__':
     t = grid_tt.reshape(-1,1)
     x = grid_xx.reshape(-1,1)
 
-    # things fixed at inference
-    H = func.hidden_states(t, x)
-    dHdt = diff(H, t)
-    d2Hdx2 = diff(H, x, 2)
-    H = torch.cat([H, torch.ones(len(H), 1)], 1)
-    dHdt = torch.cat([dHdt, torch.zeros(len(H), 1)], 1)
-    d2Hdx2 = torch.cat([d2Hdx2, torch.zeros(len(H), 1)], 1)
+    # things fixed at inference, the interior Grams in float64 (too ill-conditioned for single precision)
+    s1 = time.time()
+    if args.separable:
+        # rows are x major like grid_xx, so the x factors come first
+        TF, XF = func.axis_features(y_evals, x_evals, (0, 1), (0, 2))
+        B, C = [(1., XF[0].double(), TF[1].double())], [(1., XF[2].double(), TF[0].double())]
+        BtB, BtC, CtC = kron_gram(B), kron_gram(B, C), kron_gram(C)
+        predict = lambda W: kron_eval(XF[0], TF[0], W).reshape(-1, W.shape[1])
+    else:
+        H, dHdt, d2Hdx2 = get_hidden_derivatives(func, (t, x), [(0,), (1, 1)])
+        H = torch.cat([H, rt.ones(len(H), 1)], 1)
+        dHdt = torch.cat([dHdt, rt.zeros(len(H), 1)], 1)
+        d2Hdx2 = torch.cat([d2Hdx2, rt.zeros(len(H), 1)], 1)
+        B, C = dHdt.double(), d2Hdx2.double()
+        BtB, BtC, CtC = B.t() @ B, B.t() @ C, C.t() @ C
+        predict = lambda W: H @ W
+    print(f'{"separable" if args.separable else "dense"} {len(t)} point Gram assembly time:{time.time()-s1}')
     H0 = func.hidden_states(grid_t[:, 0].reshape(-1, 1), grid_x[:, 0].reshape(-1, 1))
-    H0 = torch.cat([H0, torch.ones(len(H0), 1)], 1)
+    H0 = torch.cat([H0, rt.ones(len(H0), 1)], 1)
     HL = func.hidden_states(grid_t[0, :].reshape(-1, 1), grid_x[0, :].reshape(-1, 1))
-    HL = torch.cat([HL, torch.ones(len(H0), 1)], 1)
+    HL = torch.cat([HL, rt.ones(len(H0), 1)], 1)
     HR = func.hidden_states(grid_t[-1, :].reshape(-1, 1), grid_x[-1, :].reshape(-1, 1))
-    HR = torch.cat([HR, torch.ones(len(H0), 1)], 1)
+    HR = torch.cat([HR, rt.ones(len(H0), 1)], 1)
 
 
     lbc = lambda z: 0*z
@@ -355,21 +366,35 @@ if __name__ == '__main__':
     true_solution_bin = []
 
 
-    for diff_i, diffusion_coeff in enumerate(diffusion_coeffs):
-        DH = (dHdt - diffusion_coeff * d2Hdx2)
-        LHS_inv = torch.linalg.inv(DH.t() @ DH + H0.t() @ H0 + HL.t() @ HL + HR.t() @ HR)
+    # LHS(lam) = P0 + lam P1 + lam^2 P2, decomposed once for the whole sweep
+    P0 = BtB + H0.t().double() @ H0.double() + HL.t().double() @ HL.double() + HR.t().double() @ HR.double()
+    P1 = -(BtC + BtC.t())
+    P2 = CtC
+    s1 = time.time()
+    sweep = LambdaSweep(P0, P1, P2)
+    print(f'sweep setup time:{time.time()-s1}')
+
+    F = torch.cat([torch.sin(force_freq * grid_x[:, 0]).reshape(-1, 1) for force_freq in force_freqs], 1)
+    RHS = H0.t() @ F + HL.t() @ BL + HR.t() @ BR
+    s1 = time.time()
+    sweep.solve(rt.linspace(diffusion_coeffs[0], diffusion_coeffs[-1], args.num_lambdas), RHS)
+    print(f'{args.num_lambdas} lambda sweep time:{time.time()-s1}, direct fallbacks:{sweep.fallbacks}')
+
+    s1 = time.time()
+    operators = [TransferOperator(sweep, diffusion_coeff, H0, HL, HR) for diffusion_coeff in diffusion_coeffs]
+    print(f'transfer operator setup time:{time.time()-s1}')
+    profiles = torch.sin(grid_x[:, 0].reshape(-1, 1) * rt.arange(1, 6).reshape(1, -1)) @ rt.randn(5, args.num_profiles)
+    s1 = time.time()
+    operators[0](profiles)
+    print(f'{args.num_profiles} initial profiles time:{time.time()-s1}')
+    Ws = [operator(F, BL.expand(-1, F.shape[1]), BR.expand(-1, F.shape[1])) for operator in operators]
 
+    for diff_i, diffusion_coeff in enumerate(diffusion_coeffs):
         for force_i,force_freq in enumerate(force_freqs):
-            f = lambda t: torch.sin(force_freq * t)
-            lbc = lambda t: 0 * t
-            rbc = lambda t: 0 * t
-            # lambda_val = 1
-
-            F = f(grid_x[:, 0]).reshape(-1, 1)
-            W0 = LHS_inv@(H0.t() @ F + HL.t() @ BL + HR.t() @ BR)
+            W0 = Ws[diff_i][:, force_i:force_i + 1]
 
             with torch.no_grad():
-                out_pred = (H@W0)
+                out_pred = predict(W0)
                 u_true = torch.sin(force_freq * grid_xx) * torch.exp(-diffusion_coeff * (force_freq**2) * grid_tt)
 
                 resids = (u_true.reshape(len(x_evals), len(y_evals)).t() - out_pred.reshape(len(x_evals),len(y_evals)).t()) ** 2
@@ -388,7 +413,8 @@ if __name__ == '__main__':
         for j in range(len(residual_bin)):
             mean_error.append( torch.max(residual_bin[j]))
 
-        mean_error = torch.tensor(mean_error)
+        mean_error = rt.tensor(mean_error)
+        print(f'max squared error, mean over cases:{mean_error.mean().item()} worst case:{mean_error.max().item()}')
         plt.figure()
 
         plt.contourf(force_freqs,diffusion_coeffs,mean_error.reshape(5,5))
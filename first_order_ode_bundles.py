@@ -27,11 +27,16 @@ parser.add_argument('--test_freq', type=int, default=20)
 parser.add_argument('--viz', action='store_false')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--gt_backend', type=str, choices=REFERENCE_BACKENDS, default='torchdiffeq')
+parser.add_argument('--gt_cache', type=str, default='', help='directory to keep the reference trajectories in')
+parser.add_argument('--gt_cache_mb', type=float, default=1024, help='size bound of the reference trajectory cache')
+add_runtime_args(parser)
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 scaler = MinMaxScaler()
 
 
-torch.set_default_tensor_type('torch.DoubleTensor')
 
 
 class diffeq(nn.Module):
@@ -42,8 +47,8 @@ class diffeq(nn.Module):
     def __init__(self, a0, f):
         super().__init__()
         # self.a1 = a1
-        self.a0 = a0
-        self.f = f
+        self.a0 = BundleCoefficients(a0)
+        self.f = BundleCoefficients(f)
 
     def forward(self, t, states):
         # print()
@@ -52,13 +57,10 @@ class diffeq(nn.Module):
         return yd.reshape(-1,1)
 
 def get_udot(t,y,a,f):
-
-    if y.shape[0] <=1:
-        a0 = torch.tensor([a_(t) for a_ in a]).reshape(1,-1)
-        f0 = torch.tensor([f_(t) for f_ in f]).reshape(1,-1)
-    else:
-        a0 = torch.cat([a_(t.reshape(-1,1)) for a_ in a],1)
-        f0 = torch.cat([f_(t.reshape(-1,1)) for f_ in f],1)
+    """
+    y' of every bundle at t (scalar or T values), a and f are BundleCoefficients or lists of functions
+    """
+    a0, f0 = [c(t) if isinstance(c, BundleCoefficients) else BundleCoefficients(c)(t) for c in (a, f)]
 
     yd = (-a0 * y + f0)
     return yd
@@ -110,13 +112,46 @@ def get_wout(s, sd, y0, t,a0s,fs):
         DH = (a1 * sd + a0 * s)
         h0m = s[0].reshape(-1, 1)
 
-        W0 = torch.linalg.solve(DH.t() @ DH + h0m @ h0m.t(), DH.t() @ D0 + h0m @ (y0[0, :].reshape(1, -1)))
+        W0 = LinearSolver(DH.t() @ DH + h0m @ h0m.t()).solve(DH.t() @ D0 + h0m @ (y0[0, :].reshape(1, -1)))
         WS.append(W0)
 
     nWS = (torch.cat(WS)).reshape(nf.shape[1], -1)
     return nWS.t()
 
 
+def unique_columns(fns, t):
+    """
+    evaluates every distinct coefficient function once and merges the ones with identical values on t
+    returns the distinct columns and, for each bundle, the index of its column
+    """
+    index = {}
+    for fn in fns:
+        index.setdefault(id(fn), (len(index), fn))
+    values = torch.cat([fn(t) for _, fn in index.values()], 1)
+    values, inverse = torch.unique(values, dim=1, return_inverse=True)
+    return values, inverse[rt.tensor([index[id(fn)][0] for fn in fns], dtype=torch.long)]
+
+
+def get_wout_grouped(s, sd, y0, t, a0s, fs):
+    """
+    same Wouts as get_wout, but the LHS only depends on a0, so bundles are grouped by their a0 values:
+    one factorization per distinct a0 and one multi-RHS solve for all its f/y0 pairs
+    """
+    a0_values, a0_index = unique_columns(a0s, t)
+    f_values, f_index = unique_columns(fs, t)
+    y0 = y0.reshape(-1)
+    h0m = s[0].reshape(-1, 1)
+
+    WS = s.new_zeros(s.shape[1], len(a0s))
+    for k in range(a0_values.shape[1]):
+        members = (a0_index == k).nonzero().ravel()
+        DH = sd + a0_values[:, k].reshape(-1, 1) * s
+        LHS = DH.t() @ DH + h0m @ h0m.t()
+        RHS = (DH.t() @ f_values)[:, f_index[members]] + h0m @ y0[members].reshape(1, -1)
+        WS[:, members] = LinearSolver(LHS).solve(RHS)
+    return WS
+
+
 
 
 if args.viz:
@@ -163,17 +198,17 @@ if __name__ == '__main__':
     a0_train = [lambda t: t,lambda t:t**2, lambda t: 1*t]
     r1 = -5.
     r2 = 5.
-    true_y0 = (r2 - r1) * torch.rand(100) + r1
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    true_y0 = (r2 - r1) * rt.rand(100) + r1
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
     # sample each parameter to build the tuples
     f_samples = random.choices(f_train, k=args.num_bundles)
     a0_samples = random.choices(a0_train, k=args.num_bundles)
-    y0_samples = torch.tensor(random.choices(true_y0, k=args.num_bundles)).reshape(1,-1)
+    y0_samples = rt.tensor(random.choices(true_y0, k=args.num_bundles)).reshape(1,-1)
 
     diffeq_init = diffeq(a0_samples,f_samples)
-    gt_generator = base_diffeq(diffeq_init)
+    gt_generator = base_diffeq(diffeq_init, args.gt_backend)
     true_y = gt_generator.get_solution(y0_samples.reshape(-1,1),t.ravel()).reshape(-1,args.num_bundles)
 
     # use this quick test to find gt solutions and check training ICs
@@ -181,7 +216,7 @@ if __name__ == '__main__':
     # true_y = gt_generator.get_solution(true_y0.reshape(-1, 1), t.ravel())
 
     # instantiate wout with coefficients
-    func = ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles)
+    func = rt.module(ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles))
 
     optimizer = optim.Adam(func.parameters(), lr=1e-3)
 
@@ -196,9 +231,9 @@ if __name__ == '__main__':
             func.train()
 
             # add t0 to training times, including randomly generated ts
-            t0 = torch.tensor([[0.]])
+            t0 = rt.tensor([[0.]])
             t0.requires_grad = True
-            tv = args.tmax * torch.rand(50).reshape(-1, 1)
+            tv = args.tmax * rt.rand(50).reshape(-1, 1)
             tv.requires_grad = True
             tv = torch.cat([t0, tv], 0)
             optimizer.zero_grad()
@@ -328,7 +363,7 @@ if __name__ == '__main__':
     # plt.legend()
     # plt.show()
 
-    func.load_state_dict(torch.load('func_ffnn_bundles'))
+    func.load_state_dict(rt.load('func_ffnn_bundles'))
     func.eval()
 
     # pred_y = func(t)
@@ -350,40 +385,38 @@ if __name__ == '__main__':
     a0_train = [lambda t: t, lambda t: t ** 2, lambda t: 1 * t]
     r1 = -5.
     r2 = 5.
-    true_y0 = (r2 - r1) * torch.rand(100) + r1
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    true_y0 = (r2 - r1) * rt.rand(100) + r1
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
     # sample each parameter to build the tuples
     f_samples = random.choices(f_train, k=args.num_bundles_test)
     a0_samples = random.choices(a0_train, k=args.num_bundles_test)
-    y0_samples = torch.tensor(random.choices(true_y0, k=args.num_bundles_test)).reshape(args.num_bundles_test,1)
-
-    diffeq_init = diffeq(a0_samples, f_samples)
-    gt_generator = base_diffeq(diffeq_init)
-
+    y0_samples = rt.tensor(random.choices(true_y0, k=args.num_bundles_test)).reshape(args.num_bundles_test,1)
 
     print(y0_samples.shape)
-    true_y = gt_generator.get_solution(y0_samples, t.ravel())
+    if args.gt_cache:
+        gt_cache = TrajectoryCache(args.gt_cache, args.gt_cache_mb * 2 ** 20)
+        true_y = gt_cache.get_solution('first_order', lambda ps: diffeq(*zip(*ps)), list(zip(a0_samples, f_samples)), y0_samples, t.ravel(), backend=args.gt_backend)
+        print(f'ground truth ({args.gt_backend}, {gt_cache.hits} cached):{gt_cache.elapsed}')
+    else:
+        gt_generator = base_diffeq(diffeq(a0_samples, f_samples), args.gt_backend)
+        true_y = gt_generator.get_solution(y0_samples, t.ravel())
+        print(f'ground truth ({args.gt_backend}):{gt_generator.elapsed}')
 
     # diffeq_init = diffeq(a0_samples, f_samples)
     # gt_generator = base_diffeq(diffeq_init)
     # true_y = gt_generator.get_solution(y0_samples, t.ravel())
     # print(true_y.shape)
-    h = func.h(t)
-    hd = diff(h, t)
-    # hdd = diff(hd, t)
-    h = h.detach()
-    hd = hd.detach()
-    # hdd = hdd.detach()
-
-    h = torch.cat([h,torch.ones(len(h),1)],1)
-    hd = torch.cat([hd,torch.zeros(len(hd),1)],1)
+    h, hd = get_hidden_derivatives(func, (t,), [(0,)])
+
+    h = torch.cat([h,rt.ones(len(h),1)],1)
+    hd = torch.cat([hd,rt.zeros(len(hd),1)],1)
     # hdd = torch.cat([hdd,torch.zeros(len(hdd),1)],1)
 
     s1 = time.time()
 
-    wout = get_wout(h, hd, y0_samples, t.detach(), a0_samples, f_samples)
+    wout = get_wout_grouped(h, hd, y0_samples, t.detach(), a0_samples, f_samples)
     print(f'wout:{time.time()-s1}')
 
     with torch.no_grad():
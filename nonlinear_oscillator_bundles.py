@@ -27,10 +27,21 @@ parser.add_argument('--test_freq', type=int, default=100)
 parser.add_argument('--viz', action='store_true')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--ham_weight', type=float, default=0.)
+parser.add_argument('--wout_solver', type=str, choices=['gauss_newton', 'perturbation'], default='gauss_newton')
+parser.add_argument('--n_orders', type=int, default=4)
+parser.add_argument('--num_queries', type=int, default=200)
+parser.add_argument('--cache_cell', type=float, default=0.05)
+parser.add_argument('--gt_backend', type=str, choices=REFERENCE_BACKENDS, default='torchdiffeq')
+parser.add_argument('--gt_cache', type=str, default='', help='directory to keep the reference trajectories in')
+parser.add_argument('--gt_cache_mb', type=float, default=1024, help='size bound of the reference trajectory cache')
+parser.add_argument('--n_windows', type=int, default=1, help='also propagate the test ICs over this many consecutive basis windows')
+add_runtime_args(parser, dtype='float32')
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 scaler = MinMaxScaler()
 
-torch.set_default_tensor_type('torch.FloatTensor')
 # print(args.evaluate_only==False)
 
 class diffeq(nn.Module):
@@ -122,12 +133,133 @@ def get_wout(s, sd,sdd, y0s, t,a1s,a0s,fs):
 
         h0m = s[0].reshape(-1, 1)
         h0d = sd[0].reshape(-1, 1)
-        W0 = torch.linalg.solve(DH.t() @ DH + h0m @ h0m.t() + h0d @ h0d.t(),
+        W0 = LinearSolver(DH.t() @ DH + h0m @ h0m.t() + h0d @ h0d.t()).solve(
                                 -DH.t() @ D0 + h0m @ (y0[:,0].reshape(1, -1)) + h0d @ (y0[:,1].reshape(1, -1)))
         WS.append(W0)
     nWS = (torch.cat(WS)).reshape(f_batch.shape[1],-1)
     return nWS.t()
 
+
+def get_residuals(s, sd, sdd, W, y0s, ham_weight):
+    """
+    stacked residuals (B x R) and their Jacobians (B x R x H) of every bundle's Wout column:
+    sdd W + sW + (sW)^3 on the grid, the two ICs and optionally the weighted energy drift
+    """
+    u, ud = (s @ W).t(), (sd @ W).t()
+    r = [(sdd @ W).t() + u + u ** 3, torch.stack([u[:, 0] - y0s[:, 0], ud[:, 0] - y0s[:, 1]], 1)]
+    J = [sdd + (1 + 3 * u ** 2).unsqueeze(2) * s, torch.stack([s[0], sd[0]]).expand(len(W.t()), 2, -1)]
+    if ham_weight > 0:
+        w = np.sqrt(ham_weight)
+        r.append(w * (get_ham(u, ud) - get_ham(y0s[:, 0:1], y0s[:, 1:2])))
+        J.append(w * ((u + u ** 3).unsqueeze(2) * s + ud.unsqueeze(2) * sd))
+    return torch.cat(r, 1), torch.cat(J, 1)
+
+
+def get_wout_gauss_newton(s, sd, sdd, y0s, w_init=None, ham_weight=0., n_iters=50, tol=1e-10, damping=1e-3):
+    """
+    Wout (H x B) of every bundle at once by batched Levenberg-Marquardt on the frozen hidden states
+
+    starts from w_init, or from the linear oscillator solution. A bundle stops once its mean squared
+    residual is below tol or an accepted step no longer lowers its cost.
+    returns Wout and the number of iterations each bundle took
+    """
+    dtype = s.dtype
+    # the normal matrices are far too ill-conditioned for single precision
+    s, sd, sdd, y0s = s.double(), sd.double(), sdd.double(), y0s.double()
+    if w_init is None:
+        DH = sdd + s
+        h0m, h0d = s[0].reshape(-1, 1), sd[0].reshape(-1, 1)
+        W = LinearSolver(DH.t() @ DH + h0m @ h0m.t() + h0d @ h0d.t()).solve(
+                               h0m @ y0s[:, 0].reshape(1, -1) + h0d @ y0s[:, 1].reshape(1, -1))
+    else:
+        W = w_init.double().clone()
+
+    iters = rt.zeros(W.shape[1], dtype=torch.long)
+    mu = rt.full((W.shape[1],), damping, dtype=W.dtype)
+    active = rt.arange(W.shape[1], dtype=torch.long)
+    r, J = get_residuals(s, sd, sdd, W, y0s, ham_weight)
+    cost = (r ** 2).sum(1)
+    stalled = torch.zeros_like(active, dtype=torch.bool)
+    for _ in range(n_iters):
+        keep = (cost / r.shape[1] >= tol) & ~stalled
+        active, r, J, cost = active[keep], r[keep], J[keep], cost[keep]
+        if len(active) == 0:
+            break
+
+        JtJ = torch.bmm(J.transpose(1, 2), J)
+        g = torch.bmm(J.transpose(1, 2), r.unsqueeze(2))
+        damp = mu[active].reshape(-1, 1) * torch.diagonal(JtJ, dim1=1, dim2=2).clamp_min(1e-12)
+        W_new = W[:, active] - LinearSolver(JtJ + torch.diag_embed(damp)).solve(g)[:, :, 0].t()
+        r_new, J_new = get_residuals(s, sd, sdd, W_new, y0s[active], ham_weight)
+        cost_new = (r_new ** 2).sum(1)
+
+        better = cost_new < cost
+        iters[active] += 1
+        W[:, active[better]] = W_new[:, better]
+        mu[active] = torch.where(better, mu[active] / 3, mu[active] * 2)
+        stalled = better & (cost - cost_new <= 1e-12 * cost)
+        r = torch.where(better.reshape(-1, 1), r_new, r)
+        J = torch.where(better.reshape(-1, 1, 1), J_new, J)
+        cost = torch.where(better, cost_new, cost)
+    return W.to(dtype), iters
+
+
+def get_wout_perturbation(s, sd, sdd, y0s, eps=1., n_orders=4, tol=None):
+    """
+    Wout (H x B) of every bundle from the series u = u_0 + eps u_1 + eps^2 u_2 + ... of u'' + u + eps u^3 = 0
+
+    every order solves the linear oscillator u_k'' + u_k = -[u^3]_{k-1} (the eps^(k-1) coefficient of the
+    cube of the lower orders), only order 0 carries the ICs, so the LHS is factored once and each order
+    is one multi-RHS solve. Each bundle keeps the partial sum with the lowest residual; with tol the
+    series stops once every bundle's mean squared residual is below it.
+    returns Wout, the order used per bundle and the mean squared residual (n_orders x B) of each partial sum
+    """
+    dtype = s.dtype
+    s, sd, sdd, y0s = s.double(), sd.double(), sdd.double(), y0s.double()
+    DH = sdd + s
+    h0m, h0d = s[0].reshape(-1, 1), sd[0].reshape(-1, 1)
+    LHS = DH.t() @ DH + h0m @ h0m.t() + h0d @ h0d.t()
+    lhs_solve = LinearSolver(LHS).solve
+
+    Ws = [lhs_solve(h0m @ y0s[:, 0].reshape(1, -1) + h0d @ y0s[:, 1].reshape(1, -1))]
+    us, sq, cube = [s @ Ws[0]], [], []
+    W = Ws[0].clone()
+    best_W, best_res = W.clone(), rt.full((W.shape[1],), float('inf'), dtype=W.dtype)
+    order = rt.zeros(W.shape[1], dtype=torch.long)
+    residuals = []
+    for k in range(n_orders):
+        if k > 0:
+            # [u^2]_m and [u^3]_m by convolving the series coefficients
+            m = k - 1
+            sq.append(sum(us[i] * us[m - i] for i in range(m + 1)))
+            cube.append(sum(sq[i] * us[m - i] for i in range(m + 1)))
+            Ws.append(lhs_solve(-DH.t() @ cube[m]))
+            us.append(s @ Ws[k])
+            W += eps ** k * Ws[k]
+        u = s @ W
+        res = ((sdd @ W + u + eps * u ** 3) ** 2).mean(0)
+        residuals.append(res)
+        better = res < best_res
+        best_W[:, better], best_res[better], order[better] = W[:, better], res[better], k
+        if tol is not None and (best_res < tol).all():
+            break
+    return best_W.to(dtype), order, torch.stack(residuals).to(dtype)
+
+
+def get_windowed_trajectory(s, sd, sdd, y0s, n_windows, wout_solver=get_wout_gauss_newton, **kwargs):
+    """
+    u, u' (T x B) of every bundle over n_windows consecutive copies of the basis window (see chain_windows)
+
+    the oscillator is autonomous, so each window is wout_solver(s, sd, sdd, y0s, **kwargs) started from the
+    previous window's end position and velocity
+    """
+    def window(y0s):
+        W = wout_solver(s, sd, sdd, y0s, **kwargs)[0]
+        u, ud = s @ W, sd @ W
+        return (u, ud), torch.stack([u[-1], ud[-1]], 1)
+
+    return chain_windows(window, y0s, n_windows)
+
 if args.viz:
     import matplotlib.pyplot as plt
 
@@ -167,14 +299,14 @@ if __name__ == '__main__':
     mu = 0
     r1 = 0.5
     r2 = 2.5
-    true_y0 = (r2 - r1) * torch.rand(100,2) + r1
+    true_y0 = (r2 - r1) * rt.rand(100,2) + r1
     true_y0[:,1] = 0.
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
 
     diffeq_init = diffeq()
-    gt_generator = base_diffeq(diffeq_init)
+    gt_generator = base_diffeq(diffeq_init, args.gt_backend)
     true_y = gt_generator.get_solution(true_y0[:args.num_bundles],t.ravel())
 
     # use this quick test to find gt solutions and check training ICs
@@ -182,7 +314,7 @@ if __name__ == '__main__':
     # true_y = gt_generator.get_solution(true_y0.reshape(-1, 1), t.ravel())
 
     # instantiate wout with coefficients
-    func = ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles)
+    func = rt.module(ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles))
 
     optimizer = optim.Adam(func.parameters(), lr=1e-3,weight_decay=1e-5)
 
@@ -196,9 +328,9 @@ if __name__ == '__main__':
             func.train()
 
             # add t0 to training times, including randomly generated ts
-            t0 = torch.tensor([[0.]])
+            t0 = rt.tensor([[0.]])
             t0.requires_grad = True
-            tr = args.tmax * torch.rand(int(args.tmax / args.dt)).reshape(-1, 1)
+            tr = args.tmax * rt.rand(int(args.tmax / args.dt)).reshape(-1, 1)
             tr.requires_grad = True
             tv = torch.cat([t0, tr], 0)
             optimizer.zero_grad()
@@ -237,67 +369,71 @@ if __name__ == '__main__':
                     print(itr,best_residual)
 
 
-    func.load_state_dict(torch.load('func_ffnn_bundles_nonlin'))
+    func.load_state_dict(rt.load('func_ffnn_bundles_nonlin'))
     func.eval()
 
-    t = torch.arange(0., args.tmax, args.dt).reshape(-1, 1)
+    t = rt.arange(0., args.tmax, args.dt).reshape(-1, 1)
     t.requires_grad = True
 
     r1 = 0.5
     r2 = 2.
-    true_y0 = (r2 - r1) * torch.rand(args.num_bundles_test, 2) + r1
+    true_y0 = (r2 - r1) * rt.rand(args.num_bundles_test, 2) + r1
     true_y0[:, 1] = 0.
 
-    diffeq_init = diffeq()
-    gt_generator = base_diffeq(diffeq_init)
-    true_y = gt_generator.get_solution(true_y0, t.ravel())
-
-    h = func.h(t)
-    hd = diff(h, t)
-    hdd = diff(hd, t)
-    h = h.detach()
-    hd = hd.detach()
-    hdd = hdd.detach()
-
-    new_net = Transformer_Learned(h.shape[1],args.num_bundles_test)
-    optimizer = optim.Adam(new_net.parameters(), lr=1e-3)
-    loss_collector = []
+    if args.gt_cache:
+        gt_cache = TrajectoryCache(args.gt_cache, args.gt_cache_mb * 2 ** 20)
+        true_y = gt_cache.get_solution('nonlinear_oscillator', lambda ps: diffeq(), [()] * len(true_y0), true_y0, t.ravel(), backend=args.gt_backend)
+        print(f'ground truth ({args.gt_backend}, {gt_cache.hits} cached):{gt_cache.elapsed}')
+    else:
+        gt_generator = base_diffeq(diffeq(), args.gt_backend)
+        true_y = gt_generator.get_solution(true_y0, t.ravel())
+        print(f'ground truth ({args.gt_backend}):{gt_generator.elapsed}')
+
+    h, hd, hdd = get_hidden_derivatives(func, (t,), [(0,), (0, 0)])
+
+    h = torch.cat([h, rt.ones(len(h), 1)], 1)
+    hd = torch.cat([hd, rt.zeros(len(hd), 1)], 1)
+    hdd = torch.cat([hdd, rt.zeros(len(hdd), 1)], 1)
 
     s1 = time.time()
-    for itr in range(1, args.niters_test + 1):
-        new_net.train()
-
-        optimizer.zero_grad()
-
-        # compute hwout,hdotwout
-        pred_y = new_net(h)
-        pred_ydot = new_net(hd)
-        pred_yddot = new_net(hdd)
-
-        # enforce diffeq
-        # get_udot(t, y, yd, a1, a0, f)
-        loss_diffeq = pred_yddot - get_udot(t, pred_y)
-        # enforce initial conditions
-        loss_ics = torch.mean((pred_y[0, :].ravel() - true_y0[:, 0].ravel()) ** 2) + torch.mean(
-            (pred_ydot[0, :].ravel() - true_y0[:, 1].ravel()) ** 2)
-
-        loss = torch.mean(torch.square(loss_diffeq)) + torch.mean(loss_ics) + torch.mean(((get_ham(pred_y,
-                                                                                                   pred_ydot)) - (
-                                                                                              get_ham(true_y0[
-                                                                                                      :,
-                                                                                                      0].reshape(1, -1),
-                                                                                                      true_y0[
-                                                                                                      :,
-                                                                                                      1].reshape(1,
-                                                                                                                 -1)))) ** 2)
-
-        loss.backward()
-        optimizer.step()
-        loss_collector.append(torch.square(loss_diffeq).mean().detach().numpy())
-
-    print(f'time:{time.time()-s1}')
+    if args.wout_solver == 'perturbation':
+        wout, orders, residuals = get_wout_perturbation(h, hd, hdd, true_y0, n_orders=args.n_orders)
+        print(f'time:{time.time()-s1}')
+        print(f'residual per order:{residuals.mean(1).tolist()}')
+        print(f'order:{orders.double().mean().item()}')
+    else:
+        wout, iters = get_wout_gauss_newton(h, hd, hdd, true_y0, ham_weight=args.ham_weight)
+        print(f'time:{time.time()-s1}')
+        print(f'iterations:{iters.double().mean().item()}')
+
+        # closely spaced queries solved one at a time, warm-started from previously solved neighbours
+        queries = true_y0[torch.randint(len(true_y0), (args.num_queries,))]
+        queries[:, 0] += 1e-2 * rt.randn(args.num_queries)
+        _, cold_iters = get_wout_gauss_newton(h, hd, hdd, queries, ham_weight=args.ham_weight)
+        cache = WoutCache(args.cache_cell)
+        warm_iters = []
+        for y0 in queries:
+            w, it = get_wout_gauss_newton(h, hd, hdd, y0.reshape(1, -1), w_init=cache.get(y0), ham_weight=args.ham_weight)
+            cache.put(y0, w)
+            warm_iters.append(it)
+        print(f'cold iterations:{cold_iters.double().mean().item()} warm iterations:{torch.cat(warm_iters).double().mean().item()} hit rate:{cache.hit_rate}')
+
+    with torch.no_grad():
+        loss_diffeq = hdd @ wout - get_udot(t, h @ wout)
     print('error')
-    print(np.mean((loss_diffeq**2).detach().numpy()),np.std((loss_diffeq**2).detach().numpy()))
+    print(np.mean((loss_diffeq**2).numpy()),np.std((loss_diffeq**2).numpy()))
+
+    if args.n_windows > 1:
+        if args.wout_solver == 'perturbation':
+            solver_kwargs = dict(wout_solver=get_wout_perturbation, n_orders=args.n_orders)
+        else:
+            solver_kwargs = dict(ham_weight=args.ham_weight)
+        with torch.no_grad():
+            s1 = time.time()
+            (win_y, win_yd), _, jumps = get_windowed_trajectory(h, hd, hdd, true_y0, args.n_windows, **solver_kwargs)
+            print(f'{args.n_windows} windows to t={(len(win_y) - 1) * args.dt:.2f}:{time.time()-s1}')
+        win_true = base_diffeq(diffeq(), args.gt_backend).get_solution(true_y0, rt.arange(len(win_y)) * args.dt)
+        print(f'max jump:{max(jumps)} max error:{(win_y - win_true[:, :, 0]).abs().max().item()}')
 
     import matplotlib
     matplotlib.rcParams['text.usetex'] = True
@@ -312,10 +448,8 @@ if __name__ == '__main__':
 
 
     with torch.no_grad():
-        new_net.eval()
-
-        pred_y = new_net(h).detach().numpy()
-        pred_yd = new_net(hd).detach().numpy()
+        pred_y = (h @ wout).numpy()
+        pred_yd = (hd @ wout).numpy()
 
         # plt.figure()
         f, (a0,a1) = plt.subplots(2, 1, gridspec_kw={'height_ratios': [4, 1]},figsize=(6,8))
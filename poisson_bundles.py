@@ -27,10 +27,21 @@ parser.add_argument('--bs', type=int, default=100)
 parser.add_argument('--viz', action='store_true')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--sampling', type=str, choices=['uniform', 'leverage', 'gaussian', 'countsketch'], default='uniform')
+parser.add_argument('--target', type=float, default=None, help='grow the sketch until the PDE residual is below this')
+parser.add_argument('--sketch_sizes', type=int, nargs='*', default=[], help='print the sketch size/error tradeoff for these sizes')
+parser.add_argument('--n_interior', type=int, default=500, help='interior collocation points for Wout, 0 uses the whole grid')
+parser.add_argument('--separable', action='store_true', help='hidden states h_t(t) * h_x(x), Wout from the whole grid by Kronecker structure')
+add_runtime_args(parser)
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
+
+# the whole-grid Wouts (streamed or Kronecker) scale their PDE rows to the weight this many uniformly
+# sampled collocation points give them, relative to the boundary rows
+PDE_WEIGHT_SAMPLES = 500
 
 
-torch.set_default_tensor_type('torch.DoubleTensor')
 
 class SiLU(nn.Module):
     def __init__(self):
@@ -100,23 +111,34 @@ class Transformer_Analytic(nn.Module):
     def append_ones(self,var,type='ones'):
 
         if type == 'ones':
-            return torch.cat([var,torch.ones(len(var),1)],1)
+            return torch.cat([var,rt.ones(len(var),1)],1)
 
         else:
-            return torch.cat([var,torch.zeros(len(var),1)],1)
-    def get_wout(self, func,t,x,grid_t,grid_x,ks):
-
-        zindices = np.random.choice(len(t), 500,replace=False)
-        # print(zindices)
-        t = t[zindices, :].reshape(-1, 1)
-        x = x[zindices, :].reshape(-1, 1)
-
-        H = func.hidden_states(t,x)#torch.cat([func.hidden_states(t,x),torch.ones(len(t),1)],1)
-        d2Hdt2 = torch.cat([diff(H,t,2),torch.zeros(len(H),1)],1)
-        d2Hdx2 =torch.cat([diff(H,x,2),torch.zeros(len(H),1)],1)
-        rho = self.rho(t.reshape(-1,1),x.reshape(-1,1))#torch.cat([get_rho(t.reshape(-1,1),x.reshape(-1,1),ks_val,0,ks_val,0).reshape(-1,1) for ks_val in ks],1)
-
-        DH = (d2Hdt2+d2Hdx2)
+            return torch.cat([var,rt.zeros(len(var),1)],1)
+    def interior_rows(self, func, t, x):
+        """
+        PDE rows DH = [Htt + Hxx, 0] and their right-hand side rho at the points t, x
+        """
+        H, d2Hdt2, d2Hdx2 = get_hidden_derivatives(func, (t, x), [(0, 0), (1, 1)])
+        d2Hdt2 = torch.cat([d2Hdt2,rt.zeros(len(H),1)],1)
+        d2Hdx2 =torch.cat([d2Hdx2,rt.zeros(len(H),1)],1)
+        with torch.no_grad():
+            rho = self.rho(t.reshape(-1,1),x.reshape(-1,1))#torch.cat([get_rho(t.reshape(-1,1),x.reshape(-1,1),ks_val,0,ks_val,0).reshape(-1,1) for ks_val in ks],1)
+        return d2Hdt2+d2Hdx2, rho
+
+    def get_wout(self, func,t,x,grid_t,grid_x,ks,n_interior=500,chunk_size=4096,sampling='uniform',target=None,pool_size=20000,
+                 axes=None):
+        """
+        Wout from n_interior random interior points, or all of them (streamed in chunks) when n_interior is None
+
+        with axes = (x_evals, y_evals), the grid t, x was built from, and a SeparableODEFunc, all grid points enter
+        through kron_gram / kron_rhs on the 1D factors instead.
+
+        sampling other than uniform (leverage, gaussian, countsketch) sketches the PDE rows of pool_size candidate
+        points down to n_interior rows (see sketch_rows); with target, the sketch is grown until the mean squared
+        PDE residual on the pool is below it. Either way the rows keep the weight n_interior samples give them;
+        the whole-grid paths are scaled to the weight of PDE_WEIGHT_SAMPLES samples.
+        """
         xindices = np.random.choice(len(grid_t),150,replace=False)
 
         H0 = func.hidden_states(grid_t[xindices,0].reshape(-1,1),grid_x[xindices,0].reshape(-1,1))
@@ -135,17 +157,47 @@ class Transformer_Analytic(nn.Module):
         BL = self.lbc(grid_t[0,xindices]).reshape(-1,1)
         BR = self.rbc(grid_t[-1,xindices]).reshape(-1,1)
 
-        LHS = DH.t() @ DH +2*torch.eye(len(DH.t()))+ H0.t() @ H0 + HT.t() @ HT + HL.t() @ HL + HR.t() @ HR
-        RHS = DH.t()@rho + H0.t()@BB + HT.t()@TB + HL.t()@BL + HR.t()@BR
-        # print(torch.linalg.cond(LHS))
+        if axes is not None:
+            TF, XF = func.axis_features(axes[1], axes[0], (0, 2), (0, 2))
+            terms = [(1., XF[0], TF[2]), (1., XF[2], TF[0])]
+            with torch.no_grad():
+                F = self.rho(t, x).reshape(len(axes[0]), len(axes[1]), -1)
+            weight = PDE_WEIGHT_SAMPLES / len(t)
+            DHtDH, DHtrho = kron_gram(terms) * weight, kron_rhs(terms, F) * weight
+        elif n_interior is None:
+            DHtDH, DHtrho = stream_normal_equations(func, (t, x), [(1., (0, 0)), (1., (1, 1))], self.rho, chunk_size)
+            weight = PDE_WEIGHT_SAMPLES / len(t)
+            DHtDH, DHtrho = DHtDH * weight, DHtrho * weight
+        elif sampling == 'uniform' and target is None:
+            zindices = np.random.choice(len(t), n_interior,replace=False)
+            # print(zindices)
+            DH, rho = self.interior_rows(func, t[zindices, :].reshape(-1, 1), x[zindices, :].reshape(-1, 1))
+            DHtDH, DHtrho = DH.t() @ DH, DH.t() @ rho
+        else:
+            pool = np.random.choice(len(t), min(pool_size, len(t)), replace=False)
+            DH_pool, rho_pool = self.interior_rows(func, t[pool, :].reshape(-1, 1), x[pool, :].reshape(-1, 1))
+            scale = (n_interior / len(pool)) ** 0.5
+            if target is None:
+                DH, rho = sketch_rows(DH_pool, rho_pool, n_interior, sampling)
+            else:
+                LHS_b = 2*rt.eye(DH_pool.shape[1]) + H0.t() @ H0 + HT.t() @ HT + HL.t() @ HL + HR.t() @ HR
+                RHS_b = H0.t()@BB + HT.t()@TB + HL.t()@BL + HR.t()@BR
+                solve = lambda SA, Sb: LinearSolver(scale ** 2 * SA.t() @ SA + LHS_b).solve(scale ** 2 * SA.t() @ Sb + RHS_b)
+                DH, rho, _, _ = fewest_rows(DH_pool, rho_pool, solve, target, sampling)
+            DH, rho = scale * DH, scale * rho
+            DHtDH, DHtrho = DH.t() @ DH, DH.t() @ rho
 
-        W0solve = torch.linalg.solve(LHS, RHS)
-        # return W0,d2Hdt2,d2Hdx2
+        if n_interior is None or axes is not None:
+            # the collocation rows are never held at once, so the solve runs on the normal equations
+            LHS = DHtDH +2*rt.eye(len(DHtDH))+ H0.t() @ H0 + HT.t() @ HT + HL.t() @ HL + HR.t() @ HR
+            RHS = DHtrho + H0.t()@BB + HT.t()@TB + HL.t()@BL + HR.t()@BR
+            self.solver = LinearSolver(LHS)
+            return self.solver.solve(RHS)
 
-        new_mat_A = torch.cat([DH,H0,HT,HL,HR,2*torch.eye(len(DH.t()))],0)
-        new_mat_Y = torch.cat([rho,torch.ones(len(H0),1)*0,torch.ones(len(HT),1)*0,torch.ones(len(HL),1)*0,torch.ones(len(HR),1)*0,torch.ones(len(DH.t()),1)*0],0)
-        W0 = torch.linalg.lstsq(new_mat_A,new_mat_Y)#torch.linalg.solve(LHS, DH.t()@rho + H0.t()@BB + HT.t()@TB + HL.t()@BL + HR.t()@BR)
-        return W0.solution,W0solve
+        new_mat_A = torch.cat([DH,H0,HT,HL,HR,2**0.5*rt.eye(len(DH.t()))],0)
+        new_mat_Y = torch.cat([rho,BB,TB,BL,BR,rt.zeros(len(DH.t()),rho.shape[1])],0)
+        self.solver = LinearSolver.from_rows(new_mat_A)
+        return self.solver.solve_rows(new_mat_Y)
 
 
 
@@ -204,8 +256,8 @@ if __name__ == '__main__':
     xr = 1.
     t0 = 0.
     tmax = 1.
-    x_evals = torch.linspace(xl,xr,100)
-    y_evals = torch.linspace(t0,tmax,100)
+    x_evals = rt.linspace(xl,xr,100)
+    y_evals = rt.linspace(t0,tmax,100)
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
     grid_x.requires_grad = True
     grid_t.requires_grad = True
@@ -213,19 +265,23 @@ if __name__ == '__main__':
     grid_t = torch.ravel(grid_t)
 
     # left BC
-    bc_left = torch.ones(100)*xl
-    bc_right = torch.ones(100)*xr
-    ic_t0 = torch.ones(100)*t0
-    ic_tmax = torch.ones(100)*tmax
+    bc_left = rt.ones(100)*xl
+    bc_right = rt.ones(100)*xr
+    ic_t0 = rt.ones(100)*t0
+    ic_tmax = rt.ones(100)*tmax
 
     bc_left.requires_grad=True
     bc_right.requires_grad=True
     ic_t0.requires_grad=True
     ic_tmax.requires_grad=True
-    func = ODEFunc(hidden_dim=NDIMZ,output_dim=4)
+    if args.separable:
+        func = rt.module(SeparableODEFunc(hidden_dim=NDIMZ,output_dim=4,nl=SiLU()))
+    else:
+        func = rt.module(ODEFunc(hidden_dim=NDIMZ,output_dim=4))
+    checkpoint = 'func_ffnn_helm_2_separable' if args.separable else 'func_ffnn_helm_2'
     optimizer = optim.Adam(func.parameters(), lr=1e-3)
 
-    center_xs = torch.tensor([[1.,1.],[2.,2.],[3.,3.],[4.,4.],[1.,1.]])
+    center_xs = rt.tensor([[1.,1.],[2.,2.],[3.,3.],[4.,4.],[1.,1.]])
     center_ys = torch.zeros_like(center_xs)
 
     loss_collector = []
@@ -234,9 +290,9 @@ if __name__ == '__main__':
 
         for itr in range(1, args.niters + 1):
             func.train()
-            indices = torch.tensor(np.random.choice(len(grid_x),1000,replace=False))
-            x_tr = (grid_x[indices]).reshape(-1,1) + 0.005*torch.rand(len(indices),1)
-            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*torch.rand(len(indices),1)
+            indices = rt.tensor(np.random.choice(len(grid_x),1000,replace=False), dtype=torch.long)
+            x_tr = (grid_x[indices]).reshape(-1,1) + 0.005*rt.rand(len(indices),1)
+            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*rt.rand(len(indices),1)
 
             # add t0 to training times, including randomly generated ts
             optimizer.zero_grad()
@@ -294,7 +350,7 @@ if __name__ == '__main__':
                 current_residual = loss_diffeq.item()
                 print(current_residual)
                 if current_residual < best_residual:
-                    torch.save(func.state_dict(), 'func_ffnn_helm_2')
+                    torch.save(func.state_dict(), checkpoint)
                     best_residual = current_residual
                     print(itr, best_residual)
 
@@ -321,19 +377,19 @@ if __name__ == '__main__':
 
     wout_gen = Transformer_Analytic(fb,ft,lbc,rbc,rho)
 
-    func.load_state_dict(torch.load('func_ffnn_helm_2',map_location=torch.device('cpu')))
+    func.load_state_dict(rt.load(checkpoint))
     func.eval()
 
-    x_evals = torch.linspace(xl, xr, 500)
-    y_evals = torch.linspace(t0, tmax, 500)
+    x_evals = rt.linspace(xl, xr, 500)
+    y_evals = rt.linspace(t0, tmax, 500)
     x_evals.requires_grad = True
     y_evals.requires_grad = True
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
 
-    kval = torch.tensor(0.)
+    kval = rt.tensor(0.)
 
-    x_evals1 = torch.linspace(xl+0.01, xr-0.01, 200)
-    y_evals1 = torch.linspace(t0+0.01, tmax-0.01, 200)
+    x_evals1 = rt.linspace(xl+0.01, xr-0.01, 200)
+    y_evals1 = rt.linspace(t0+0.01, tmax-0.01, 200)
     x_evals1.requires_grad = True
     y_evals1.requires_grad = True
     grid_x1, grid_t1 = torch.meshgrid(x_evals1, y_evals1)
@@ -341,19 +397,37 @@ if __name__ == '__main__':
     grid_xx = grid_x1.ravel()
     grid_tt = grid_t1.ravel()
 
-    kvals = torch.linspace(1.,4.,100)
+    kvals = rt.linspace(1.,4.,100)
 
     t1 = time.time()
-    WOUT,WOUT1 = wout_gen.get_wout(func,grid_t.reshape(-1,1),grid_x.reshape(-1,1),grid_t1,grid_x1,kvals)
-    print(f'time:{time.time()-t1}')
+    WOUT = wout_gen.get_wout(func,grid_t.reshape(-1,1),grid_x.reshape(-1,1),grid_t1,grid_x1,kvals,n_interior=args.n_interior or None,
+                                    sampling=args.sampling,target=args.target,
+                                    axes=(x_evals, y_evals) if args.separable else None)
+    print(f'time:{time.time()-t1} solver:{wout_gen.solver.method}')
+
+    if args.sketch_sizes:
+        # fidelity of the sketched PDE block alone: least squares on the sketch against the full pool residual
+        pool = np.random.choice(len(grid_t.reshape(-1)), 20000, replace=False)
+        DH_pool, rho_pool = wout_gen.interior_rows(func, grid_t.reshape(-1, 1)[pool], grid_x.reshape(-1, 1)[pool])
+        solve = lambda SA, Sb: LinearSolver.from_rows(SA).solve_rows(Sb)
+        print(f'full pool residual:{((DH_pool @ solve(DH_pool, rho_pool) - rho_pool) ** 2).mean().item()}')
+        for method in ['uniform', 'leverage', 'gaussian', 'countsketch']:
+            for m, error, seconds in sketch_tradeoff(DH_pool, rho_pool, solve, args.sketch_sizes, method):
+                print(f'{method} rows:{m} residual:{error} time:{seconds}')
     tv,xv = grid_t.reshape(-1, 1), grid_x.reshape(-1, 1)
     #
-    H = func.hidden_states(tv,xv)
-    H = torch.cat([H,torch.ones(len(H),1)],1)
+    t1 = time.time()
+    with torch.no_grad():
+        if args.separable:
+            TF, XF = func.axis_features(y_evals, x_evals)
+            out_pred = kron_eval(XF[0], TF[0], WOUT).reshape(-1, WOUT.shape[1]).numpy()
+        else:
+            H = func.hidden_states(tv,xv)
+            H = torch.cat([H,rt.ones(len(H),1)],1)
+            out_pred = (H@WOUT).numpy()
+    print(f'{len(tv)} point evaluation time:{time.time()-t1}')
 
     with torch.no_grad():
-        out_pred = (H@WOUT).numpy()
-        out_pred1 = (H@WOUT1).numpy()
 
         # np.save('out_pred.npy',out_pred)
         # np.save('out_pred1.npy',out_pred1)
@@ -370,12 +444,10 @@ if __name__ == '__main__':
         u_true = 1./4*(2*u_analytic(grid_x,grid_t,1)-4*u_analytic(grid_x,grid_t,2)+6*u_analytic(grid_x,grid_t,3)-8*u_analytic(grid_x,grid_t,4))
 
         s1 = np.transpose(out_pred.reshape(len(x_evals), len(y_evals)))
-        s2 = np.transpose(out_pred1.reshape(len(x_evals), len(y_evals)))
 
-        print(s1,s2,u_true.numpy())
+        print(s1,u_true.numpy())
 
-        print(f'error:{((s1-u_true.numpy())**2).mean()}')
-        print(f'error1:{((s2 - u_true.numpy()) ** 2).mean(),((s2 - u_true.numpy()) ** 2).std()}')
+        print(f'error:{((s1 - u_true.numpy()) ** 2).mean(),((s1 - u_true.numpy()) ** 2).std()}')
 
         # plt.figure()
         # contours = plt.contour(x_evals, y_evals, out_pred.reshape(len(x_evals), len(y_evals)).t(), 6, colors='black')
@@ -390,19 +462,9 @@ if __name__ == '__main__':
         #
         # fig, ax = plt.subplots(1,1, figsize=(10, 5))
 
-        plt.figure()
-        cmp=sns.color_palette("rocket", as_cmap=True)
-        plt.contourf(x_evals, y_evals, np.transpose(out_pred.reshape(len(x_evals), len(y_evals))),levels=20,cmap=cmp)
-        plt.xlabel(r'$x$')
-        plt.ylabel(r'$y$')
-        plt.colorbar()
-        plt.savefig('helm_2_qr.pdf', dpi=2400, bbox_inches='tight')
-
-
-
         plt.figure(figsize=(8,6))
         cmp=sns.color_palette("rocket", as_cmap=True)
-        plt.contourf(x_evals, y_evals, np.transpose(out_pred1.reshape(len(x_evals), len(y_evals))),levels=20,cmap=cmp)
+        plt.contourf(x_evals, y_evals, np.transpose(out_pred.reshape(len(x_evals), len(y_evals))),levels=20,cmap=cmp)
         # plt.colorbar()
         plt.xlabel(r'$x$')
         plt.ylabel(r'$y$')
@@ -411,7 +473,7 @@ if __name__ == '__main__':
 
         plt.figure(figsize=(8,6))
         cmp = sns.color_palette("rocket", as_cmap=True)
-        errf = (np.transpose(out_pred1.reshape(len(x_evals), len(y_evals)))-u_true.numpy())**2
+        errf = (np.transpose(out_pred.reshape(len(x_evals), len(y_evals)))-u_true.numpy())**2
         print(errf.min())
         plt.contourf(x_evals, y_evals,errf , cmap=cmp)
         # plt.colorbar()
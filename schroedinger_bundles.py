@@ -1,6 +1,8 @@
 """
 base solver for transfer ode (first order methods)
 """
+import os
+import hashlib
 import torch
 import torch.nn as nn
 import argparse
@@ -39,10 +41,21 @@ parser.add_argument('--bs', type=int, default=100)
 parser.add_argument('--viz', action='store_true')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_false')
-
+parser.add_argument('--sampling', type=str, choices=['uniform', 'leverage', 'gaussian', 'countsketch'], default='uniform')
+parser.add_argument('--target', type=float, default=None, help='grow the sketch until the PDE residual is below this')
+parser.add_argument('--sketch_sizes', type=int, nargs='*', default=[], help='print the sketch size/error tradeoff for these sizes')
+parser.add_argument('--wout_form', type=str, choices=['complex', 'real'], default='complex',
+                    help='one complex (H+1) system, or the real/imaginary 2(H+1) block system')
+parser.add_argument('--max_memory_mb', type=float, default=256, help='memory budget of the tiled error sweep')
+parser.add_argument('--truth_cache', type=str, default='', help='directory to keep the exact |psi|^2 tables of the sweep in')
+parser.add_argument('--separable', action='store_true', help='hidden states h_t(t) * h_x(x), evaluated on the grid by Kronecker structure')
+parser.add_argument('--n_windows', type=int, default=1, help='also propagate the packets over this many consecutive time windows')
+
+add_runtime_args(parser)
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 
-torch.set_default_tensor_type('torch.DoubleTensor')
 
 
 class ODEFunc(nn.Module):
@@ -57,7 +70,7 @@ class ODEFunc(nn.Module):
         self.nl2 = SiLU()
         self.lin1 = nn.Linear(2, self.hdim)
         self.lin2 = nn.Linear(self.hdim, self.hdim)
-        self.weight_2 = nn.Parameter(torch.zeros(1))
+        self.weight_2 = nn.Parameter(rt.zeros(1))
         self.lout = nn.Linear(self.hdim, output_dim, bias=True)
 
     def hidden_states(self, t,x):
@@ -85,92 +98,209 @@ def psi(t,x,m,sig,p0,x0=0.):
     return fac1*np.exp(fac2)*np.exp(fac3)
 
 
+def param_columns(sigmas, p0s):
+    """
+    (sigma, p0) of every column of a sweep, sigma major like the nested loops over sigmas and p0s
+    """
+    return sigmas.repeat_interleave(len(p0s)), p0s.repeat(len(sigmas))
 
 
+def psi_grid(t, x, sigmas, p0s, m=1., x0=0., chunk_size=8192):
+    """
+    psi broadcast over points t, x (N) and parameter columns sigmas, p0s (K) -> complex (N, K)
 
+    filled chunk_size points at a time, so only one chunk of the complex temporaries is alive.
+    psi_grid(0, x, ...) are the initial packets get_ic builds one pair at a time.
+    """
+    x = x.detach().reshape(-1, 1)
+    t = torch.as_tensor(t, dtype=x.dtype, device=x.device).detach().reshape(-1, 1).expand(len(x), 1)
+    sig, p0 = sigmas.reshape(1, -1), p0s.reshape(1, -1)
+    E = p0**2/2/m
+    out = torch.empty(len(x), sig.shape[1], dtype=torch.promote_types(x.dtype, torch.complex64), device=x.device)
+    for start in range(0, len(x), chunk_size):
+        tc, xc = t[start:start + chunk_size], x[start:start + chunk_size]
+        spread = 1+1j*tc/(m*sig**2)
+        out[start:start + chunk_size] = np.pi**(-1/4)/torch.sqrt(sig*spread)*torch.exp(
+            -(xc-(x0+p0*tc/m))**2/(2*sig**2*spread) + 1j*(p0*xc-E*tc))
+    return out
 
 
-class Transformer_Analytic(nn.Module):
+def psi_density_grid(t, x, sigmas, p0s, m=1., x0=0., chunk_size=8192):
     """
-    returns Wout analytic, need to define the parameter coefficients
+    |psi_grid|^2 in closed form, a real Gaussian of width sigma sqrt(1 + (t / m sigma^2)^2) moving at p0 / m,
+    which skips the complex sqrt and exps
     """
+    x = x.detach().reshape(-1, 1)
+    t = torch.as_tensor(t, dtype=x.dtype, device=x.device).detach().reshape(-1, 1).expand(len(x), 1)
+    sig, p0 = sigmas.reshape(1, -1), p0s.reshape(1, -1)
+    out = torch.empty(len(x), sig.shape[1], dtype=x.dtype, device=x.device)
+    for start in range(0, len(x), chunk_size):
+        tc, xc = t[start:start + chunk_size], x[start:start + chunk_size]
+        width2 = sig**2*(1+(tc/(m*sig**2))**2)
+        out[start:start + chunk_size] = torch.exp(-(xc-(x0+p0*tc/m))**2/width2)/torch.sqrt(np.pi*width2)
+    return out
+
+
+def cached_psi_density(cache_dir, t, x, sigmas, p0s, chunk_size=8192):
+    """
+    psi_density_grid table (N, K), memory-mapped from cache_dir
 
-    def __init__(self):
-        super(Transformer_Analytic, self).__init__()
+    the file name hashes every input, so a new grid or parameter set gets its own table; a missing table
+    is written chunk by chunk (never held in memory) and moved into place only when complete.
+    """
+    inputs = [v.detach().cpu().double().numpy() for v in (t.reshape(-1), x.reshape(-1), sigmas, p0s)]
+    key = hashlib.sha256(b''.join(v.tobytes() for v in inputs) + str([v.shape for v in inputs]).encode()).hexdigest()
+    path = os.path.join(cache_dir, f'psi2_{key[:24]}.npy')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        table = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float64, shape=(len(inputs[1]), len(sigmas)))
+        for start in range(0, len(x), chunk_size):
+            rows = slice(start, start + chunk_size)
+            table[rows] = psi_density_grid(t.reshape(-1)[rows], x.reshape(-1)[rows], sigmas, p0s).cpu().numpy()
+        table.flush()
+        del table
+        os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
 
 
-    def append_ones(self,var,type='ones'):
 
-        if type == 'ones':
-            return torch.cat([var,torch.ones(len(var),1)],1)
 
-        else:
-            return torch.cat([var,torch.zeros(len(var),1)],1)
 
-    def get_wout(self, func,t,x,grid_t,grid_x,sigma,p0):
 
-        # t,x = grid_t[:, -1].reshape(-1, 1), grid_x[:, -1].reshape(-1, 1)
 
-        # t,x = torch.linspace(0,1,100,requires_grad=True).reshape(-1,1),torch.linspace(-10,10,100,requires_grad=True).reshape(-1,1)
-        zindices = np.random.choice(len(t),350,replace=False)
-        # print(zindices)
-        t = t[zindices,:].reshape(-1,1)
-        x = x[zindices,:].reshape(-1,1)
+class Transformer_Analytic(nn.Module):
+    """
+    returns Wout analytic, need to define the parameter coefficients
+    """
 
+    def __init__(self):
+        super(Transformer_Analytic, self).__init__()
 
-        H = func.hidden_states(t,x)#torch.cat([func.hidden_states(t,x),torch.ones(len(t),1)],1)
-        dHdt = torch.cat([diff(H,t,1),torch.zeros(len(t),1)],1)
-        d2Hdx2 =torch.cat([diff(H,x,2),torch.zeros(len(t),1)],1)
-        H = torch.cat([H,torch.ones(len(t),1)],1)
-        Amatrix = get_block_matrix(torch.tensor(1.))
 
-        HHt = torch.block_diag(dHdt, dHdt)
-        HHxx = torch.block_diag(d2Hdx2, d2Hdx2)
-        HH = torch.block_diag(H,H)
+    def append_ones(self,var,type='ones'):
 
-        Amatrixhat = torch.zeros((HH.shape[0], HH.shape[0]))
-        for i in range(Amatrix.shape[0]):
-            for j in range(Amatrix.shape[1]):
-                Amatrixhat[i * H.shape[0]:(i + 1) * H.shape[0], j * H.shape[0]:(j + 1) * H.shape[0]] = torch.eye(
-                    H.shape[0], H.shape[0]) * Amatrix[i, j]
+        if type == 'ones':
+            return torch.cat([var,rt.ones(len(var),1)],1)
 
-        DH = (HHt-Amatrixhat@HHxx)
+        else:
+            return torch.cat([var,rt.zeros(len(var),1)],1)
+
+    def interior_rows(self, func, t, x):
+        """
+        PDE rows [Ht, 0; 0, Ht] - A [Hxx, 0; 0, Hxx] (real and imaginary parts) at the points t, x,
+        as a structured operator (see gram); to_dense gives the rows themselves
+        """
+        H, dHdt, d2Hdx2 = get_hidden_derivatives(func, (t, x), [(0,), (1, 1)])
+        dHdt = torch.cat([dHdt,rt.zeros(len(t),1)],1)
+        d2Hdx2 =torch.cat([d2Hdx2,rt.zeros(len(t),1)],1)
+        Amatrix = get_block_matrix(rt.tensor(1.))
+        I2 = rt.eye(2)
+
+        HHt = Kron(I2, dHdt)
+        HHxx = Kron(I2, d2Hdx2)
+        Amatrixhat = Kron(Amatrix, ScaledIdentity(len(t), dtype=rt.dtype, device=rt.device))
+
+        return (HHt-Amatrixhat@HHxx), dHdt, d2Hdx2
+
+    def complex_rows(self, func, t, x):
+        """
+        PDE rows i Ht + 1/2 Hxx of the complex Wout at the points t, x (psi = [H, 1] W)
+        """
+        H, dHdt, d2Hdx2 = get_hidden_derivatives(func, (t, x), [(0,), (1, 1)])
+        dHdt = self.append_ones(dHdt,'zeros')
+        d2Hdx2 = self.append_ones(d2Hdx2,'zeros')
+        return torch.complex(0.5*d2Hdx2, dHdt), dHdt, d2Hdx2
+
+    def boundary_rows(self, func, grid_t, grid_x):
+        """
+        [H, 1] at t=0 and the periodicity rows HL - HR, HLd - HRd (values and x-derivatives at the two ends)
+        """
         H0 = func.hidden_states(grid_t[:, 0].reshape(-1, 1), grid_x[:, 0].reshape(-1, 1))
         H0 = self.append_ones(H0)
-        HH0 = torch.block_diag(H0,H0)
 
         lbc = grid_x[0, :].reshape(-1, 1)
-        HL = func.hidden_states(grid_t[0, :].reshape(-1, 1),lbc)
-        HLd = diff(HL, lbc)
-
-        HL = self.append_ones(HL)
-        HHL = torch.block_diag(HL, HL)
-        HLd = self.append_ones(HLd,'zeros')
-        HHLd = torch.block_diag(HLd, HLd)
+        HL, HLd = get_hidden_derivatives(func, (grid_t[0, :].reshape(-1, 1), lbc), [(1,)])
 
         rbc = grid_x[-1, :].reshape(-1, 1)
-        HR = func.hidden_states(grid_t[-1, :].reshape(-1, 1), rbc)
-        HRd = diff(HR, rbc)
-
-        HR = self.append_ones(HR)
-        HHR = torch.block_diag(HR, HR)
-        HRd = self.append_ones(HRd,'zeros')
-        HHRd = torch.block_diag(HRd, HRd)
-
-        full_IC_matrix = []
-        for sigma_ in sigma:
-            for p0_ in p0:
-                IC = get_ic(grid_t[:, 0].reshape(-1, 1), grid_x[:, 0].reshape(-1, 1), sigma=sigma_, x0=0., p0=p0_)
-                new_IC = torch.cat([IC[:,0].ravel(),IC[:,1].ravel()]).reshape(-1,1)
-
-                full_IC_matrix.append(new_IC)
+        HR, HRd = get_hidden_derivatives(func, (grid_t[-1, :].reshape(-1, 1), rbc), [(1,)])
+
+        return H0, self.append_ones(HL)-self.append_ones(HR), self.append_ones(HLd,'zeros')-self.append_ones(HRd,'zeros')
+
+    def ic_matrix(self, grid_t, grid_x, sigma, p0):
+        """
+        complex initial wave packets on grid_x[:, 0], one column per (sigma, p0) pair (sigma major)
+        """
+        return psi_grid(0., grid_x[:, 0], *param_columns(sigma, p0))
+
+    def get_wout(self, func,t,x,grid_t,grid_x,sigma,p0,n_interior=350,sampling='uniform',target=None,pool_size=20000):
+        """
+        n_interior collocation points picked uniformly, or, for other sampling (leverage, gaussian, countsketch),
+        2 n_interior PDE rows sketched from pool_size candidate points (see sketch_rows); with target, the sketch
+        is grown until the mean squared PDE residual on the pool is below it
+        """
+        H0, HP, HPd = self.boundary_rows(func, grid_t, grid_x)
+        I2 = rt.eye(2)
+        HH0 = Kron(I2, H0)
+        HHP = Kron(I2, HP)
+        HHPd = Kron(I2, HPd)
+
+        IC = self.ic_matrix(grid_t, grid_x, sigma, p0)
+        full_IC_matrix = torch.cat([IC.real, IC.imag])
+        LVEC_b = gram(HH0) + gram(HHP) + gram(HHPd)
+
+        if sampling == 'uniform' and target is None:
+            zindices = np.random.choice(len(t),n_interior,replace=False)
+            # print(zindices)
+            DH, dHdt, d2Hdx2 = self.interior_rows(func, t[zindices,:].reshape(-1,1), x[zindices,:].reshape(-1,1))
+        else:
+            pool = np.random.choice(len(t), min(pool_size, len(t)), replace=False)
+            DH_pool, dHdt, d2Hdx2 = self.interior_rows(func, t[pool,:].reshape(-1,1), x[pool,:].reshape(-1,1))
+            DH_pool = DH_pool.to_dense()
+            zeros = rt.zeros(len(DH_pool), 1)
+            scale = (n_interior / len(pool)) ** 0.5
+            if target is None:
+                DH, _ = sketch_rows(DH_pool, zeros, 2 * n_interior, sampling)
+            else:
+                solve = lambda SA, Sb: LinearSolver(scale ** 2 * SA.t() @ SA + LVEC_b).solve(HH0.t() @ full_IC_matrix)
+                DH, _, _, _ = fewest_rows(DH_pool, zeros, solve, target, sampling)
+            DH = scale * DH
+
+        LVEC = gram(DH) + LVEC_b
+        self.solver = LinearSolver(LVEC)
+        W0 = self.solver.solve(HH0.t()@full_IC_matrix)
 
-        full_IC_matrix = torch.hstack(full_IC_matrix)
+        return W0,dHdt,d2Hdx2
 
-        LVEC = DH.t() @ DH + HH0.t() @ HH0 + (HHL-HHR).t()@(HHL-HHR) + (HHLd-HHRd).t()@(HHLd-HHRd)
-        W0 = torch.linalg.solve(LVEC,HH0.t()@full_IC_matrix)
+    def get_wout_complex(self, func,t,x,grid_t,grid_x,sigma,p0,n_interior=350,sampling='uniform',target=None,pool_size=20000):
+        """
+        get_wout with a complex W: one (H+1) Hermitian system instead of the 2(H+1) real block system
+
+        |i r| = |r|, so the objective is the real one (the real rows are the real and imaginary parts of these);
+        a complex row counts as the two real rows it replaces when sketching
+        """
+        H0, HP, HPd = self.boundary_rows(func, grid_t, grid_x)
+        full_IC_matrix = self.ic_matrix(grid_t, grid_x, sigma, p0)
+        cdtype = full_IC_matrix.dtype
+        LVEC_b = (H0.t() @ H0 + HP.t() @ HP + HPd.t() @ HPd).to(cdtype)
+        RHS = H0.t().to(cdtype) @ full_IC_matrix
+
+        if sampling == 'uniform' and target is None:
+            zindices = np.random.choice(len(t),n_interior,replace=False)
+            DH, dHdt, d2Hdx2 = self.complex_rows(func, t[zindices,:].reshape(-1,1), x[zindices,:].reshape(-1,1))
+        else:
+            pool = np.random.choice(len(t), min(pool_size, len(t)), replace=False)
+            DH_pool, dHdt, d2Hdx2 = self.complex_rows(func, t[pool,:].reshape(-1,1), x[pool,:].reshape(-1,1))
+            zeros = torch.zeros(len(DH_pool), 1, dtype=cdtype, device=rt.device)
+            scale = (n_interior / len(pool)) ** 0.5
+            if target is None:
+                DH, _ = sketch_rows(DH_pool, zeros, n_interior, sampling)
+            else:
+                solve = lambda SA, Sb: LinearSolver(scale ** 2 * SA.mH @ SA + LVEC_b).solve(RHS)
+                DH, _, _, _ = fewest_rows(DH_pool, zeros, solve, target, sampling)
+            DH = scale * DH
 
-        return W0,dHdt,d2Hdx2
+        self.solver = LinearSolver(DH.mH @ DH + LVEC_b)
+        return self.solver.solve(RHS),dHdt,d2Hdx2
 
 
 if args.viz:
@@ -195,11 +325,11 @@ def visualize(func,u,t,x,grid_t,grid_x,lst):
         # ax_phase.contourf(x, t, (u[:, 0]**2 + u[:,1]**2).reshape(len(x), len(t)).t())
 
         # ps1= get_ic(torch.ones(500)*0,torch.linspace(-10.,10.,500),0.5,x0=0.,p0=1.)
-        ps11 = psi(torch.ones(500)*0,torch.linspace(-10.,10.,500), 1, 0.5, 1, x0=0)
-        ps2 = psi(torch.ones(500) * 0, torch.linspace(-10., 10., 500), 1, 0.6, 2, x0=0)
-        ps3 = psi(torch.ones(500) * 0, torch.linspace(-10., 10., 500), 1, 0.7, 3, x0=0)
+        ps11 = psi(rt.ones(500)*0,rt.linspace(-10.,10.,500), 1, 0.5, 1, x0=0)
+        ps2 = psi(rt.ones(500) * 0, rt.linspace(-10., 10., 500), 1, 0.6, 2, x0=0)
+        ps3 = psi(rt.ones(500) * 0, rt.linspace(-10., 10., 500), 1, 0.7, 3, x0=0)
 
-        unew = func(torch.ones(500)*0,torch.linspace(-10.,10.,500))
+        unew = func(rt.ones(500)*0,rt.linspace(-10.,10.,500))
 
         with torch.no_grad():
         # unew1 = func(torch.ones(50) * 2., torch.linspace(-10., 10., 50))
@@ -215,9 +345,9 @@ def visualize(func,u,t,x,grid_t,grid_x,lst):
             ax_phase.plot(np.real(ps2))
             ax_phase.plot(np.imag(ps2))
 
-            ps1 = psi(torch.ones(500) * .5, torch.linspace(-10., 10., 500), 1, 0.5, 1, x0=0)
+            ps1 = psi(rt.ones(500) * .5, rt.linspace(-10., 10., 500), 1, 0.5, 1, x0=0)
 
-            unew = func(torch.ones(500) * 0.5, torch.linspace(-10., 10., 500))
+            unew = func(rt.ones(500) * 0.5, rt.linspace(-10., 10., 500))
 
             ax_vecfield.plot(np.real(ps1))
             ax_vecfield.plot(np.imag(ps1))
@@ -242,7 +372,7 @@ def get_ic(t,x,sigma=0.5,x0=0.,p0=1.):
 
     hbar = 1.
 
-    sigma = torch.tensor(sigma)
+    sigma = rt.tensor(sigma)
 
     c1= 1./np.pi**(1./4.)
     c2 = 1./torch.sqrt(sigma)
@@ -267,7 +397,7 @@ def get_block_matrix(m1):
     # m2 = m2.reshape(1,-1)
     # print(m1[0,0])
     for i in range(m1.shape[1]):
-        Amatrix.append(torch.tensor([[0.,-hbar/(2.*m1[0,i])],[hbar/(2.*m1[0,i]),0]]))
+        Amatrix.append(rt.tensor([[0.,-hbar/(2.*m1[0,i])],[hbar/(2.*m1[0,i]),0]]))
 
     # print(torch.block_diag(*Amatrix).shape)
     return torch.block_diag(*Amatrix)
@@ -277,12 +407,54 @@ def get_block_matrix(m1):
 def get_transform(x):
     hbar = 1.
     m = 1.
-    Amatrix = torch.tensor([[0.,-hbar/(2.*m)],[hbar/(2.*m),0]])
+    Amatrix = rt.tensor([[0.,-hbar/(2.*m)],[hbar/(2.*m),0]])
 
     output = Amatrix @ x.t()
     return output.t()
 
 
+def grid_hidden_states(func, x_evals, y_evals):
+    """
+    [H, 1] on torch.meshgrid(x_evals, y_evals), from the 1D factors when func is separable
+    """
+    if isinstance(func, SeparableODEFunc):
+        TF, XF = func.axis_features(y_evals, x_evals)
+        return kron_rows(XF[0], TF[0])
+    grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
+    return torch.cat([func.hidden_states(grid_t.reshape(-1, 1), grid_x.reshape(-1, 1)), rt.ones(grid_x.numel(), 1)], 1)
+
+
+def predict_psi(H, W):
+    """
+    psi on the rows of [H, 1] as a complex (N, K) tensor, for either Wout form
+    """
+    if W.is_complex():
+        return H.to(W.dtype) @ W
+    out = Kron(rt.eye(2), H) @ W
+    return torch.complex(out[:len(H)], out[len(H):])
+
+
+def get_windowed_psi(solver, H, n_x, psi0, n_windows, wout_form='complex'):
+    """
+    psi (T x n_x x K) over n_windows consecutive copies of the time window of the [H, 1] grid (x major,
+    as grid_hidden_states), started from the complex packets psi0 (n_x x K) (see chain_windows)
+
+    only the IC rows depend on the packets, so the system factored by get_wout / get_wout_complex (solver)
+    is kept: each window is one solve against H0^T times the previous window's psi at its last time
+    """
+    H0 = H.reshape(n_x, -1, H.shape[1])[:, 0]
+
+    def window(psi0):
+        if wout_form == 'complex':
+            W = solver.solve(H0.t().to(psi0.dtype) @ psi0)
+        else:
+            W = solver.solve(torch.cat([H0.t() @ psi0.real, H0.t() @ psi0.imag]))
+        out = predict_psi(H, W).reshape(n_x, -1, psi0.shape[1]).transpose(0, 1)
+        return out, out[-1]
+
+    return chain_windows(window, psi0, n_windows)
+
+
 if __name__ == '__main__':
 
     ii = 0
@@ -291,8 +463,8 @@ if __name__ == '__main__':
     xr = 10.#torch.tensor(np.pi)
     t0 = 0.
     tmax = 1.#torch.tensor(np.pi)
-    x_evals = torch.linspace(xl,xr,100)
-    y_evals = torch.linspace(t0,tmax,100)
+    x_evals = rt.linspace(xl,xr,100)
+    y_evals = rt.linspace(t0,tmax,100)
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
     grid_x.requires_grad = True
     grid_t.requires_grad = True
@@ -300,13 +472,13 @@ if __name__ == '__main__':
     grid_x = grid_x.ravel()
     grid_t = grid_t.ravel()
 
-    bc_left = torch.ones(100)*xl
-    bc_right = torch.ones(100)*xr
-    ic_t0 = torch.ones(100)*t0
-    ic_tmax = torch.ones(100)*tmax
+    bc_left = rt.ones(100)*xl
+    bc_right = rt.ones(100)*xr
+    ic_t0 = rt.ones(100)*t0
+    ic_tmax = rt.ones(100)*tmax
 
 
-    ms_diffeq = torch.ones(args.num_ics)
+    ms_diffeq = rt.ones(args.num_ics)
     DIFF_MATRIX = get_block_matrix(ms_diffeq)
 
     bc_left.requires_grad=True
@@ -314,7 +486,10 @@ if __name__ == '__main__':
     ic_t0.requires_grad=True
     ic_tmax.requires_grad=True
 
-    func = ODEFunc(hidden_dim=NDIMZ,output_dim=2*args.num_ics)
+    if args.separable:
+        func = rt.module(SeparableODEFunc(hidden_dim=NDIMZ,output_dim=2*args.num_ics,nl=SiLU()))
+    else:
+        func = rt.module(ODEFunc(hidden_dim=NDIMZ,output_dim=2*args.num_ics))
 
     optimizer = optim.Adam(func.parameters(), lr=1e-3)
 
@@ -327,9 +502,9 @@ if __name__ == '__main__':
 
         for itr in range(1, args.niters + 1):
             func.train()
-            indices = torch.tensor(np.random.choice(len(grid_x),1000))
-            x_tr = (grid_x[indices]).reshape(-1,1) + 0.1*torch.rand(len(indices),1)
-            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*torch.rand(len(indices),1)
+            indices = rt.tensor(np.random.choice(len(grid_x),1000), dtype=torch.long)
+            x_tr = (grid_x[indices]).reshape(-1,1) + 0.1*rt.rand(len(indices),1)
+            t_tr = (grid_t[indices]).reshape(-1,1) + 0.005*rt.rand(len(indices),1)
 
             # add t0 to training times, including randomly generated ts
             optimizer.zero_grad()
@@ -371,36 +546,38 @@ if __name__ == '__main__':
 
                 visualize(func,u,y_evals,x_evals,grid_t,grid_x, loss_collector)
                 if loss_diffeq.item() < best_residual:
-                    torch.save(func.state_dict(), 'func_ffnn_schroed')
+                    torch.save(func.state_dict(), 'func_ffnn_schroed_separable' if args.separable else 'func_ffnn_schroed')
                     best_residual = loss_diffeq.item()
 
-    func.load_state_dict(torch.load('func_ffnn_schroed2',map_location=torch.device('cpu')))
+    func.load_state_dict(rt.load('func_ffnn_schroed_separable' if args.separable else 'func_ffnn_schroed2'))
     func.eval()
 
     tmax = 0.5
 
-    x_evals = torch.linspace(xl, xr, 200)
-    y_evals = torch.linspace(t0, tmax, 200)
+    x_evals = rt.linspace(xl, xr, 200)
+    y_evals = rt.linspace(t0, tmax, 200)
     x_evals.requires_grad = True
     y_evals.requires_grad = True
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
 
 
-    sigmas =torch.tensor([0.5,0.6,0.7])#torch.tensor([0.5,0.6,0.7])#torch.linspace(0.5,0.9,100)
-    p0s =torch.tensor([1.,2.,3.])#torch.tensor([1.,2.,3.])#torch.linspace(1.,4.,100)
+    sigmas =rt.tensor([0.5,0.6,0.7])#torch.tensor([0.5,0.6,0.7])#torch.linspace(0.5,0.9,100)
+    p0s =rt.tensor([1.,2.,3.])#torch.tensor([1.,2.,3.])#torch.linspace(1.,4.,100)
 
     wout_gen = Transformer_Analytic()
     grid_xx = grid_x.ravel()
     grid_tt = grid_t.ravel()
 
     # func, t, x, grid_t, grid_x, sigma, p0
+    get_wout = wout_gen.get_wout_complex if args.wout_form == 'complex' else wout_gen.get_wout
     s1 = time.time()
-    WOUT,Ht,Hxx = wout_gen.get_wout(func,grid_tt.reshape(-1,1),grid_xx.reshape(-1,1),grid_t,grid_x,sigmas,p0s)
-    print(f'time:{time.time()-s1}')
+    WOUT,Ht,Hxx = get_wout(func,grid_tt.reshape(-1,1),grid_xx.reshape(-1,1),grid_t,grid_x,sigmas,p0s,
+                           sampling=args.sampling,target=args.target)
+    print(f'time:{time.time()-s1} system size:{len(WOUT)} solver:{wout_gen.solver.method}')
 
-    H = torch.cat([func.hidden_states(grid_tt.reshape(-1,1),grid_xx.reshape(-1,1)),torch.ones(len(grid_xx),1)],1)
-
-    HH = torch.block_diag(H,H)
+    s1 = time.time()
+    H = grid_hidden_states(func, x_evals, y_evals)
+    print(f'{len(H)} point evaluation time:{time.time()-s1}')
 
     teval_point = .5
 
@@ -414,16 +591,16 @@ if __name__ == '__main__':
 
     axs = ax.ravel()
     with torch.no_grad():
-        out_pred = HH@WOUT
+        out_pred = predict_psi(H, WOUT)
         idx = 0
         for sigma_ in sigmas:
             for p0_ in p0s:
                 gt_psi = psi(teval_point,x_evals, 1., sigma_, p0_, x0=0)
                 gt_real = np.real(gt_psi)
                 gt_img = np.imag(gt_psi)
-                pred_psi = (out_pred[:,idx]).reshape(-1,1)
-                pred_psi_real = (pred_psi[:len(grid_xx), 0]).reshape(len(x_evals), len(y_evals)).t()
-                pred_psi_img = (pred_psi[len(grid_xx):, 0]).reshape(len(x_evals), len(y_evals)).t()
+                pred_psi = out_pred[:,idx].reshape(len(x_evals), len(y_evals)).t()
+                pred_psi_real = pred_psi.real
+                pred_psi_img = pred_psi.imag
 
 
                 if ([sigma_,p0_] == [0.5,1.]) or([sigma_,p0_] == [0.6,2.]) or ([sigma_,p0_] == [0.7,3.]):
@@ -451,6 +628,16 @@ if __name__ == '__main__':
         # plt.tight_layout()
         plt.savefig('schroedinger.pdf',dpi=2400,bbox_inches='tight')
 
+    if args.n_windows > 1:
+        with torch.no_grad():
+            s1 = time.time()
+            psi0 = psi_grid(0., x_evals, *param_columns(sigmas, p0s))
+            win_psi, _, jumps = get_windowed_psi(wout_gen.solver, H.detach(), len(x_evals), psi0, args.n_windows, args.wout_form)
+            print(f'{args.n_windows} windows to t={args.n_windows * tmax}:{time.time()-s1}')
+            errors = [(win_psi[k * (len(y_evals) - 1)] - psi_grid(k * tmax, x_evals, *param_columns(sigmas, p0s))).abs().max().item()
+                      for k in range(1, args.n_windows + 1)]
+        print(f'max jump:{max(jumps)} max error at window ends:{errors}')
+
     # tmax = 1.
     #
     # x_evals = torch.linspace(xl, xr, 200)
@@ -494,36 +681,35 @@ if __name__ == '__main__':
                     rc={"font.size": 30, "axes.titlesize": 25, "axes.labelsize": 30, "axes.legendsize": 20,
                         'lines.linewidth': 3.})
 
-    sigmas = torch.linspace(0.3,1.5,50)
-    p0s = torch.linspace(.7,5.,50)
+    sigmas = rt.linspace(0.3,1.5,50)
+    p0s = rt.linspace(.7,5.,50)
 
-    x_evals = torch.linspace(xl, xr, 200)
-    y_evals = torch.linspace(t0, tmax, 200)
+    x_evals = rt.linspace(xl, xr, 200)
+    y_evals = rt.linspace(t0, tmax, 200)
     x_evals.requires_grad = True
     y_evals.requires_grad = True
     grid_x, grid_t = torch.meshgrid(x_evals, y_evals)
 
-    WOUT, Ht, Hxx = wout_gen.get_wout(func, grid_t.reshape(-1, 1), grid_x.reshape(-1, 1), grid_t, grid_x, sigmas,p0s)
-    H = torch.cat([func.hidden_states(grid_t.reshape(-1, 1), grid_x.reshape(-1, 1)), torch.ones(len(grid_x.ravel()), 1)],1)
-    HH = torch.block_diag(H, H)
+    s1 = time.time()
+    WOUT, Ht, Hxx = get_wout(func, grid_t.reshape(-1, 1), grid_x.reshape(-1, 1), grid_t, grid_x, sigmas,p0s)
+    print(f'{len(sigmas)*len(p0s)} case time:{time.time()-s1}')
+    H = grid_hidden_states(func, x_evals, y_evals).detach()
     from matplotlib import ticker, cm
-    idx = 0
+    s1 = time.time()
     with torch.no_grad():
-        out_pred = HH @ WOUT
-        error = np.zeros(int(len(sigmas)*len(p0s)))
-        errormeans = np.zeros(int(len(sigmas) * len(p0s)))
-
-        for sigma_ in sigmas:
-            for p0_ in p0s:
-                pred_psi = (out_pred[:, idx]).reshape(-1, 1)
-                pred_psi_real = (pred_psi[:len(grid_x.ravel()), 0]).reshape(len(x_evals), len(y_evals)).t()
-                pred_psi_img = (pred_psi[len(grid_x.ravel()):, 0]).reshape(len(x_evals), len(y_evals)).t()
-
-                predwf = pred_psi_real ** 2 + pred_psi_img ** 2
-                gtwf = (np.abs(psi(grid_t,grid_x,1.,sigma_,p0_)))**2
-                error[idx] =torch.max((np.transpose(gtwf) - predwf)**2)
-                errormeans[idx] = torch.mean((np.transpose(gtwf) - predwf)**2)
-                idx+=1
+        # |psi|^2 errors of every (sigma, p0) column, streamed in tiles instead of the full H @ WOUT
+        WOUT = WOUT.detach()
+        gt_t, gt_x = grid_t.reshape(-1), grid_x.reshape(-1)
+        sigma_cols, p0_cols = param_columns(sigmas, p0s)
+        prediction = lambda rows, cols: predict_psi(H[rows], WOUT[:, cols]).abs() ** 2
+        if args.truth_cache:
+            table = cached_psi_density(args.truth_cache, gt_t, gt_x, sigma_cols, p0_cols)
+            truth = lambda rows, cols: rt.tensor(np.array(table[rows, cols]))
+        else:
+            truth = lambda rows, cols: psi_density_grid(gt_t[rows], gt_x[rows], sigma_cols[cols], p0_cols[cols])
+        error, errormeans = tiled_column_stats(prediction, truth, len(H), len(sigma_cols), args.max_memory_mb * 2 ** 20)
+        error, errormeans = error.cpu().numpy(), errormeans.cpu().numpy()
+    print(f'error sweep time:{time.time()-s1}')
 
     print('error')
     print(np.mean(errormeans),np.std(errormeans))
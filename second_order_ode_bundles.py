@@ -17,7 +17,6 @@ matplotlib.rcParams['text.usetex'] = True
 import matplotlib.pyplot as plt
 
 
-torch.set_default_tensor_type('torch.DoubleTensor')
 
 
 
@@ -36,7 +35,13 @@ parser.add_argument('--test_freq', type=int, default=20)
 parser.add_argument('--viz', action='store_true')
 parser.add_argument('--gpu', type=int, default=0)
 parser.add_argument('--evaluate_only', action='store_true')
+parser.add_argument('--gt_backend', type=str, choices=REFERENCE_BACKENDS, default='torchdiffeq')
+parser.add_argument('--gt_cache', type=str, default='', help='directory to keep the reference trajectories in')
+parser.add_argument('--gt_cache_mb', type=float, default=1024, help='size bound of the reference trajectory cache')
+add_runtime_args(parser)
 args = parser.parse_args()
+rt = Runtime(args)
+rt.report()
 scaler = MinMaxScaler()
 
 # print(args.evaluate_only==False)
@@ -48,9 +53,9 @@ class diffeq(nn.Module):
 
     def __init__(self,a1, a0, f):
         super().__init__()
-        self.a1 = a1
-        self.a0 = a0
-        self.f = f
+        self.a1 = BundleCoefficients(a1)
+        self.a0 = BundleCoefficients(a0)
+        self.f = BundleCoefficients(f)
 
     # return ydot
     def forward(self, t, states):
@@ -63,17 +68,10 @@ class diffeq(nn.Module):
 # get_udot(tv,pred_y,pred_ydot,a1_samples,a0_samples,f_samples)
 
 def get_udot(t,y,yd,a1,a0,f):
-
-    #a1 is 1
-    # print(t.dim())
-    if y.shape[0] <=1:
-        a1s = torch.tensor([a_(t) for a_ in a1]).reshape(1, -1)
-        a0s = torch.tensor([a_(t) for a_ in a0]).reshape(1,-1)
-        f0s = torch.tensor([f_(t) for f_ in f]).reshape(1,-1)
-    else:
-        a1s = torch.cat([a_(t) for a_ in a1], 1)
-        a0s = torch.cat([a_(t) for a_ in a0],1)
-        f0s = torch.cat([f_(t) for f_ in f],1)
+    """
+    y'' of every bundle at t (scalar or T values), a1, a0, f are BundleCoefficients or lists of functions
+    """
+    a1s, a0s, f0s = [c(t) if isinstance(c, BundleCoefficients) else BundleCoefficients(c)(t) for c in (a1, a0, f)]
 
     ydd = (-a1s*yd -a0s * y + f0s)
     return ydd
@@ -107,32 +105,55 @@ class ODEFunc(nn.Module):
         x = self.nl(x)
         return x
 
-def get_wout(s, sd,sdd, y0s, t,a1s,a0s,fs):
+def get_wout(s, sd,sdd, y0s, t,a1s,a0s,fs, chunk_size=32):
     # y0 = torch.stack([y0 for _ in range(len(s))]).reshape(len(s), -1)
 
 
     a0_batch = torch.cat([var_(t) for var_ in a0s], 1)
     a1_batch = torch.cat([var_(t) for var_ in a1s], 1)
     f_batch = torch.cat([var_(t) for var_ in fs], 1)
+
+    h0m = s[0,:].reshape(-1, 1)
+    h0d = sd[0,:].reshape(-1, 1)
+    IC = h0m @ h0m.t() + h0d @ h0d.t()
+
+    # every bundle's DH is stacked into a (chunk, T, H) tensor, so each chunk costs one bmm and one
+    # batched factorization; chunk_size bounds the memory of the stacked DH
     WS = []
-    for i in range(f_batch.shape[1]):
-        y0 = y0s[i,:].reshape(1,-1)
-        a0 = a0_batch[:,i].reshape(-1,1)
-        a1 = a1_batch[:,i].reshape(-1,1)
-        f = f_batch[:,i].reshape(-1,1)
-
-        # print(a0,a1,f)
-        DH = (sdd + a1 * sd + a0 * s)
-        D0 = f
-
-        h0m = s[0,:].reshape(-1, 1)
-        h0d = sd[0,:].reshape(-1, 1)
-        W0 = torch.linalg.solve(DH.t() @ DH + h0m @ h0m.t() + h0d @ h0d.t(),
-                                DH.t() @ D0 + h0m @ (y0[:,0].reshape(1, -1)) + h0d @ (y0[:,1].reshape(1, -1)))
-        # print(W0.shape)
-        WS.append(W0)
-    nWS = (torch.cat(WS)).reshape(f_batch.shape[1],-1)
-    return nWS.t()
+    for i in range(0, f_batch.shape[1], chunk_size):
+        a0 = a0_batch[:, i:i + chunk_size].t().unsqueeze(2)
+        a1 = a1_batch[:, i:i + chunk_size].t().unsqueeze(2)
+        f = f_batch[:, i:i + chunk_size].t().unsqueeze(2)
+        y0 = y0s[i:i + chunk_size].unsqueeze(2)
+
+        DH = torch.addcmul(torch.addcmul(sdd, a1, sd), a0, s)
+        LHS = torch.bmm(DH.transpose(1, 2), DH) + IC
+        RHS = torch.bmm(DH.transpose(1, 2), f) + h0m * y0[:, 0:1] + h0d * y0[:, 1:2]
+
+        WS.append(LinearSolver(LHS).solve(RHS)[:, :, 0])
+    return torch.cat(WS).t()
+
+
+def get_dictionary(t):
+    """
+    function dictionary the test coefficients are written in: 1, t, t^2, t^3, cos t, sin t, sin t cos t
+    """
+    return torch.cat([torch.ones_like(t), t, t ** 2, t ** 3, torch.cos(t), torch.sin(t), torch.sin(t) * torch.cos(t)], 1)
+
+
+def get_wout_gram(gram, s, sd, y0s, a1_coeffs, a0_coeffs, f_coeffs):
+    """
+    get_wout for coefficients given in the get_dictionary basis, assembled from a WeightedGram of (sdd, sd, s)
+    """
+    lead = torch.zeros_like(a1_coeffs)
+    lead[:, 0] = 1.
+    LHS, RHS = gram.normal_equations(torch.stack([lead, a1_coeffs, a0_coeffs], 1), f_coeffs)
+
+    h0m = s[0, :].reshape(-1, 1)
+    h0d = sd[0, :].reshape(-1, 1)
+    LHS = LHS + h0m @ h0m.t() + h0d @ h0d.t()
+    RHS = RHS + y0s[:, 0].reshape(-1, 1) * h0m.t() + y0s[:, 1].reshape(-1, 1) * h0d.t()
+    return LinearSolver(LHS).solve(RHS.unsqueeze(2))[:, :, 0].t()
 
 
 if args.viz:
@@ -193,18 +214,18 @@ if __name__ == '__main__':
     a1_train = [lambda z: 0*z,lambda z: z**2, lambda z: z**3]
     r1 = -5.
     r2 = 5.
-    true_y0 = (r2 - r1) * torch.rand(100,2) + r1
-    t = torch.linspace(0., args.tmax, 60).reshape(-1, 1)
+    true_y0 = (r2 - r1) * rt.rand(100,2) + r1
+    t = rt.linspace(0., args.tmax, 60).reshape(-1, 1)
     t.requires_grad = True
 
     # sample each parameter to build the tuples
     f_samples = random.choices(f_train, k=args.num_bundles)
     a0_samples = random.choices(a0_train, k=args.num_bundles)
     a1_samples = random.choices(a1_train, k=args.num_bundles)
-    y0_samples = true_y0[torch.tensor(random.choices(range(len(true_y0)), k=args.num_bundles))]
+    y0_samples = true_y0[rt.tensor(random.choices(range(len(true_y0)), k=args.num_bundles), dtype=torch.long)]
 
     diffeq_init = diffeq(a1_samples,a0_samples,f_samples)
-    gt_generator = base_diffeq(diffeq_init)
+    gt_generator = base_diffeq(diffeq_init, args.gt_backend)
     true_y = gt_generator.get_solution(y0_samples,t.ravel())
 
     gt_generator = estim_diffeq(diffeq_init)
@@ -215,7 +236,7 @@ if __name__ == '__main__':
     # true_y = gt_generator.get_solution(true_y0.reshape(-1, 1), t.ravel())
 
     # instantiate wout with coefficients
-    func = ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles)
+    func = rt.module(ODEFunc(hidden_dim=NDIMZ, output_dim=args.num_bundles))
 
     optimizer = optim.Adam(func.parameters(), lr=5e-3)
 
@@ -231,9 +252,9 @@ if __name__ == '__main__':
             func.train()
 
             # add t0 to training times, including randomly generated ts
-            t0 = torch.tensor([[0.]])
+            t0 = rt.tensor([[0.]])
             t0.requires_grad = True
-            tr = args.tmax * torch.rand(50).reshape(-1, 1)
+            tr = args.tmax * rt.rand(50).reshape(-1, 1)
             tr.requires_grad = True
             tv = torch.cat([t0, tr], 0)
             optimizer.zero_grad()
@@ -263,16 +284,11 @@ if __name__ == '__main__':
                 pred_ydot = pred_ydot.detach()
                 pred_yddot = pred_yddot.detach()
 
-                h = func.h(t)
-                hd = diff(h, t)
-                hdd = diff(hd, t)
-                h = h.detach()
-                hd = hd.detach()
-                hdd = hdd.detach()
+                h, hd, hdd = get_hidden_derivatives(func, (t,), [(0,), (0, 0)])
 
-                h = torch.cat([h, torch.ones(len(h), 1)], 1)
-                hd = torch.cat([hd, torch.zeros(len(hd), 1)], 1)
-                hdd = torch.cat([hdd, torch.zeros(len(hdd), 1)], 1)
+                h = torch.cat([h, rt.ones(len(h), 1)], 1)
+                hd = torch.cat([hd, rt.zeros(len(hd), 1)], 1)
+                hdd = torch.cat([hdd, rt.zeros(len(hdd), 1)], 1)
 
                 wouts = get_wout(h, hd, hdd, y0_samples, t.detach(), a1_samples, a0_samples, f_samples)
 
@@ -315,7 +331,7 @@ if __name__ == '__main__':
                         print(itr,best_residual)
 
 
-    func.load_state_dict(torch.load('func_ffnn_bundles_sec_trsf'))
+    func.load_state_dict(rt.load('func_ffnn_bundles_sec_trsf'))
     func.eval()
 
     # pred_y = func(t)
@@ -336,41 +352,48 @@ if __name__ == '__main__':
     f_train = [lambda z: 0. * z, lambda z: 1 + 0 * z, lambda z: torch.cos(z), lambda z: torch.sin(z),lambda z: torch.sin(z)*torch.cos(z)]
     a0_train = [lambda z: 1. + 0. * z, lambda z: 3 * z, lambda z: z ** 2,lambda z: z**3]
     a1_train = [lambda z: 0 * z, lambda z: z ** 2, lambda z: z ** 3]
+    # the same coefficients written in the get_dictionary basis
+    f_coeffs = torch.cat([rt.zeros(1, 7), rt.eye(7)[[0, 4, 5, 6]]])
+    a0_coeffs = rt.eye(7)[[0, 1, 2, 3]] * rt.tensor([1., 3., 1., 1.]).reshape(-1, 1)
+    a1_coeffs = torch.cat([rt.zeros(1, 7), rt.eye(7)[[2, 3]]])
     r1 = -5.
     r2 = 5.
-    true_y0 = (r2 - r1) * torch.rand(args.num_bundles_test, 2) + r1
-    t = torch.linspace(0., args.tmax, 60).reshape(-1, 1)
+    true_y0 = (r2 - r1) * rt.rand(args.num_bundles_test, 2) + r1
+    t = rt.linspace(0., args.tmax, 60).reshape(-1, 1)
     t.requires_grad = True
 
     # sample each parameter to build the tuples
-    f_samples = random.choices(f_train, k=args.num_bundles_test)
-
-    # for fs in f_samples:
-    #     print(fs(t))
-
-    a0_samples = random.choices(a0_train, k=args.num_bundles_test)
-    a1_samples = random.choices(a1_train, k=args.num_bundles_test)
-    y0_samples = true_y0[torch.tensor(random.choices(range(len(true_y0)), k=args.num_bundles_test))]
-
-    diffeq_init = diffeq(a1_samples, a0_samples, f_samples)
-    gt_generator = base_diffeq(diffeq_init)
-    true_y = gt_generator.get_solution(y0_samples, t.ravel())
+    f_idx = random.choices(range(len(f_train)), k=args.num_bundles_test)
+    a0_idx = random.choices(range(len(a0_train)), k=args.num_bundles_test)
+    a1_idx = random.choices(range(len(a1_train)), k=args.num_bundles_test)
+    f_samples = [f_train[i] for i in f_idx]
+    a0_samples = [a0_train[i] for i in a0_idx]
+    a1_samples = [a1_train[i] for i in a1_idx]
+    y0_samples = true_y0[rt.tensor(random.choices(range(len(true_y0)), k=args.num_bundles_test), dtype=torch.long)]
+
+    if args.gt_cache:
+        gt_cache = TrajectoryCache(args.gt_cache, args.gt_cache_mb * 2 ** 20)
+        true_y = gt_cache.get_solution('second_order', lambda ps: diffeq(*zip(*ps)), list(zip(a1_samples, a0_samples, f_samples)), y0_samples, t.ravel(), backend=args.gt_backend)
+        print(f'ground truth ({args.gt_backend}, {gt_cache.hits} cached):{gt_cache.elapsed}')
+    else:
+        gt_generator = base_diffeq(diffeq(a1_samples, a0_samples, f_samples), args.gt_backend)
+        true_y = gt_generator.get_solution(y0_samples, t.ravel())
+        print(f'ground truth ({args.gt_backend}):{gt_generator.elapsed}')
     # true_y = true_y[:,:,0]
 
 
-    h = func.h(t)
-    hd = diff(h, t)
-    hdd = diff(hd, t)
-    h = h.detach()
-    hd = hd.detach()
-    hdd = hdd.detach()
+    h, hd, hdd = get_hidden_derivatives(func, (t,), [(0,), (0, 0)])
 
-    h = torch.cat([h,torch.ones(len(h),1)],1)
-    hd = torch.cat([hd,torch.zeros(len(hd),1)],1)
-    hdd = torch.cat([hdd,torch.zeros(len(hdd),1)],1)
+    h = torch.cat([h,rt.ones(len(h),1)],1)
+    hd = torch.cat([hd,rt.zeros(len(hd),1)],1)
+    hdd = torch.cat([hdd,rt.zeros(len(hdd),1)],1)
+
+    s1 = time.time()
+    gram = WeightedGram([hdd, hd, h], get_dictionary(t.detach()))
+    print(f'gram:{time.time()-s1}')
 
     s1 = time.time()
-    wout = get_wout(h, hd, hdd, y0_samples, t.detach(), a1_samples, a0_samples, f_samples)
+    wout = get_wout_gram(gram, h, hd, y0_samples, a1_coeffs[a1_idx], a0_coeffs[a0_idx], f_coeffs[f_idx])
     print(f'wout:{time.time()-s1}')
 
     with torch.no_grad():
@@ -0,0 +1,37 @@
+import torch
+
+from utils import LinearSolver
+
+
+def spd_batch(n=20, batch=3):
+    A = torch.randn(batch, n, n, dtype=torch.float64)
+    lhs = A @ A.mT + n * torch.eye(n, dtype=torch.float64)
+    return lhs, torch.randn(batch, n, 2, dtype=torch.float64)
+
+
+def relative_residual(lhs, W, b):
+    return (torch.linalg.norm(lhs @ W - b) / torch.linalg.norm(b)).item()
+
+
+def test_linear_solver_paths(tol=1e-8):
+    """
+    every LinearSolver path but qr (which factors rows, see from_rows) solves a random SPD batch
+    """
+    lhs, b = spd_batch()
+    for method in LinearSolver.PATHS:
+        if method == 'qr':
+            continue
+        W = LinearSolver(lhs, method=method).solve(b)
+        assert relative_residual(lhs, W, b) < tol, method
+
+
+def test_linear_solver_lu_fallback(n=20, tol=1e-8):
+    """
+    in a mixed batch the LU fallback of an indefinite system lines up with its row
+    """
+    lhs, b = spd_batch(n)
+    lhs[1] = torch.diag(torch.linspace(-1., 1., n + 1, dtype=torch.float64)[torch.arange(n + 1) != n // 2])
+    solver = LinearSolver(lhs)
+    W = solver.solve(b)
+    assert solver.path[1] == 4
+    assert relative_residual(lhs, W, b) < tol
@@ -1,9 +1,21 @@
 """
 utility files needed to run code
 """
+import hashlib
+import itertools
+import json
+import os
+import time
+import types
+import warnings
+from collections import OrderedDict
+import numpy as np
 import torch
 import torch.nn as nn
+from torch.func import jvp
+import torchdiffeq
 from torchdiffeq import odeint_adjoint as odeint
+from scipy.integrate import solve_ivp
 
 
 class SiLU(nn.Module):
@@ -19,69 +31,1162 @@ class SiLU(nn.Module):
         '''
         return torch.sin(input)
 
+
+REFERENCE_BACKENDS = ('torchdiffeq', 'adjoint', 'rk4', 'scipy')
+
+
 class base_diffeq:
     """
     integrates base_solver given y0 and time
+
+    the whole batch y0 (B x D) is one system, so every call of base_solver evaluates all bundles at once.
+    backends: 'torchdiffeq' (odeint with method, dopri8 by default), 'adjoint' (odeint_adjoint, same
+    solution but only worth it when gradients are needed), 'rk4' (classical RK4, substeps fixed steps per
+    interval of t) and 'scipy' (solve_ivp with method, DOP853 by default, on the flattened batch).
+    the wall time of the last solve is kept in elapsed
     """
 
-    def __init__(self, base_solver):
+    def __init__(self, base_solver, backend='torchdiffeq', method=None, substeps=10, rtol=1e-7, atol=1e-9):
+        if backend not in REFERENCE_BACKENDS:
+            raise ValueError(f'unknown backend {backend}, expected one of {REFERENCE_BACKENDS}')
         self.base = base_solver
+        self.backend = backend
+        self.method = method or ('DOP853' if backend == 'scipy' else 'dopri8')
+        self.substeps = substeps
+        self.rtol, self.atol = rtol, atol
+        self.elapsed = None
 
     def get_solution(self, true_y0, t):
+        t = t.detach()
+        s1 = time.time()
         with torch.no_grad():
-            true_y = odeint(self.base, true_y0, t, method='dopri8')
+            if self.backend == 'rk4':
+                true_y = self._rk4(true_y0, t)
+            elif self.backend == 'scipy':
+                true_y = self._scipy(true_y0, t)
+            else:
+                solve = odeint if self.backend == 'adjoint' else torchdiffeq.odeint
+                true_y = solve(self.base, true_y0, t, method=self.method, rtol=self.rtol, atol=self.atol)
+        self.elapsed = time.time() - s1
         return true_y
 
+    def _rk4(self, y, t):
+        ys = [y]
+        for t0, t1 in zip(t[:-1], t[1:]):
+            dt = (t1 - t0) / self.substeps
+            for k in range(self.substeps):
+                s = t0 + k * dt
+                k1 = self.base(s, y)
+                k2 = self.base(s + dt / 2, y + dt / 2 * k1)
+                k3 = self.base(s + dt / 2, y + dt / 2 * k2)
+                k4 = self.base(s + dt, y + dt * k3)
+                y = y + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            ys.append(y)
+        return torch.stack(ys)
+
+    def _scipy(self, y0, t):
+        kw = dict(dtype=y0.dtype, device=y0.device)
+
+        def rhs(s, y):
+            return self.base(torch.tensor(s, **kw), torch.as_tensor(y, **kw).reshape(y0.shape)).reshape(-1).cpu().numpy()
+
+        t_eval = t.cpu().numpy()
+        sol = solve_ivp(rhs, (t_eval[0], t_eval[-1]), y0.reshape(-1).cpu().numpy(), method=self.method,
+                        t_eval=t_eval, rtol=self.rtol, atol=self.atol)
+        return torch.as_tensor(sol.y.T, **kw).reshape(len(t), *y0.shape)
+
     def get_deriv(self, true_y0, t):
         with torch.no_grad():
             true_ydot = self.base(t, true_y0)
         return true_ydot
 
 
-class estim_diffeq:
+class estim_diffeq(base_diffeq):
     """
-    integrates base_solver given y0 and time
+    integrates base_solver given y0 and time with the fixed-grid midpoint rule on t
     """
 
-    def __init__(self, base_solver):
-        self.base = base_solver
+    def __init__(self, base_solver, backend='torchdiffeq', method='midpoint'):
+        super().__init__(base_solver, backend, method)
 
-    def get_solution(self, true_y0, t):
-        with torch.no_grad():
-            true_y = odeint(self.base, true_y0, t, method='midpoint')
-        return true_y
 
-    def get_deriv(self, true_y0, t):
-        with torch.no_grad():
-            true_ydot = self.base(t, true_y0)
-        return true_ydot
+class BundleCoefficients:
+    """
+    per-bundle coefficient functions, evaluated vectorized over the bundles
+
+    bundles draw their coefficients from a few distinct functions, so each distinct one is evaluated
+    once per call and gathered to its bundles. called on t (scalar or T values) it returns (T, B)
+    """
+
+    def __init__(self, fns):
+        distinct = {}
+        for fn in fns:
+            distinct.setdefault(id(fn), (len(distinct), fn))
+        self.fns = [fn for _, fn in distinct.values()]
+        self.index = torch.tensor([distinct[id(fn)][0] for fn in fns], dtype=torch.long)
+
+    def __call__(self, t):
+        t = torch.as_tensor(t).reshape(-1, 1)
+        values = torch.cat([fn(t).reshape(len(t), 1) for fn in self.fns], 1)
+        return values[:, self.index.to(values.device)]
+
+
+def add_runtime_args(parser, device='cpu', dtype='float64'):
+    """
+    device/dtype/threading options shared by every script, read back by Runtime(args)
+    """
+    parser.add_argument('--device', type=str, default=device, help="cpu, cuda, cuda:<i> or auto")
+    parser.add_argument('--dtype', type=str, choices=['float32', 'float64'], default=dtype)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the torch default')
+    parser.add_argument('--interop_threads', type=int, default=0, help='inter-op threads, 0 keeps the torch default')
+    return parser
+
+
+class Runtime:
+    """
+    explicit device and dtype for every tensor a script allocates, so no global torch defaults are needed
+
+    the constructors mirror torch's; integer tensors (indices) are made by passing a dtype explicitly.
+    """
+
+    def __init__(self, args):
+        device = args.device
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.dtype = getattr(torch, args.dtype)
+        if args.threads > 0:
+            torch.set_num_threads(args.threads)
+        if args.interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(args.interop_threads)
+            except RuntimeError:
+                # only allowed before the first parallel op
+                pass
+        if self.device.type == 'cuda':
+            torch.backends.cudnn.benchmark = True
+
+    def _kw(self, kw):
+        kw.setdefault('dtype', self.dtype)
+        kw.setdefault('device', self.device)
+        return kw
+
+    def tensor(self, data, **kw):
+        return torch.as_tensor(data, **self._kw(kw))
+
+    def zeros(self, *size, **kw):
+        return torch.zeros(*size, **self._kw(kw))
+
+    def ones(self, *size, **kw):
+        return torch.ones(*size, **self._kw(kw))
+
+    def full(self, size, value, **kw):
+        return torch.full(size, value, **self._kw(kw))
+
+    def rand(self, *size, **kw):
+        return torch.rand(*size, **self._kw(kw))
+
+    def randn(self, *size, **kw):
+        return torch.randn(*size, **self._kw(kw))
+
+    def linspace(self, start, end, steps, **kw):
+        return torch.linspace(start, end, steps, **self._kw(kw))
+
+    def arange(self, *args, **kw):
+        return torch.arange(*args, **self._kw(kw))
+
+    def eye(self, *size, **kw):
+        return torch.eye(*size, **self._kw(kw))
+
+    def module(self, module):
+        return module.to(device=self.device, dtype=self.dtype)
+
+    def load(self, path):
+        return torch.load(path, map_location=self.device)
+
+    def report(self, n=1024, repeats=5):
+        """
+        prints the configuration and a GEMM throughput estimate
+        """
+        # constant operands, so the report does not shift the scripts' random draws
+        A, B = self.full((n, n), 0.5), self.full((n, n), 2.)
+        A @ B
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        s1 = time.time()
+        for _ in range(repeats):
+            A @ B
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        gflops = 2 * n ** 3 * repeats / (time.time() - s1) / 1e9
+        print(f'device:{self.device} dtype:{self.dtype} threads:{torch.get_num_threads()} '
+              f'interop threads:{torch.get_num_interop_threads()} gemm:{gflops:.1f} GFLOP/s')
 
 
 def diff(u, t, order=1):
     # code adapted from neurodiffeq library
     # https://github.com/NeuroDiffGym/neurodiffeq/blob/master/neurodiffeq/neurodiffeq.py
     r"""The derivative of a variable with respect to another.
+
+    Row i of u may only depend on row i of t (true for every ODEFunc here), so the derivative of all
+    columns is the jacobian-vector product J @ 1, taken with two backward passes instead of one per column.
+    """
+    der = u
+    for _ in range(order):
+        v = torch.zeros_like(der, requires_grad=True)
+        vjp = torch.autograd.grad(der, t, grad_outputs=v, create_graph=True)[0]
+        der = torch.autograd.grad(vjp, v, grad_outputs=torch.ones_like(t), create_graph=True)[0]
+    return der
+
+
+def _unit_tangents(inputs, index):
+    return tuple(torch.ones_like(x) if i == index else torch.zeros_like(x) for i, x in enumerate(inputs))
+
+
+def _directional(fn, inputs, index):
+    tangents = _unit_tangents(inputs, index)
+    return lambda *xs: jvp(fn, xs, tangents)[1]
+
+
+def get_derivatives(fn, inputs, partials=((0,),), create_graph=True):
+    """
+    evaluates fn(*inputs) and the requested partials of every output column in one batched pass
+
+    inputs are (N,1) tensors and fn has to act row-wise (all ODEFunc nets do), so each partial is a
+    nested forward-mode jvp with unit tangents rather than one backward pass per column.
+    partials are tuples of input indices, e.g. [(0,), (0, 0), (1, 1)] -> u_t, u_tt, u_xx for fn(t, x).
+    create_graph=True keeps the graph for training, False builds none and returns detached tensors.
+    returns [fn(*inputs), *partials]
+    """
+    # meshgrid slices can be stride-0 views, which forward-mode AD refuses to wrap
+    inputs = tuple(x.contiguous() for x in inputs)
+    partials = [tuple(p) for p in partials]
+    results = {}
+    with torch.enable_grad() if create_graph else torch.no_grad():
+        # the highest order jvp also returns the partial one order below it for free
+        for p in sorted(partials, key=len, reverse=True):
+            if p in results:
+                continue
+            g = fn
+            for i in p[:-1]:
+                g = _directional(g, inputs, i)
+            results[p[:-1]], results[p] = jvp(g, inputs, _unit_tangents(inputs, p[-1]))
+        if () not in results:
+            results[()] = fn(*inputs)
+    return [results[()]] + [results[p] for p in partials]
+
+
+_TWO_LAYER_PARAMETERS = {'lin1.weight', 'lin1.bias', 'lin2.weight', 'lin2.bias', 'lout.weight', 'lout.bias'}
+
+
+def _activation_kind(func):
+    """
+    returns 'sin' or 'tanh' if func is lin1 -> act -> lin2 -> act with a single sine/tanh act, else None
+    """
+    if {name for name, _ in func.named_parameters()} - _TWO_LAYER_PARAMETERS:
+        return None
+    acts = [m for m in func.children() if not isinstance(m, nn.Linear)]
+    if len(acts) != 1:
+        return None
+    probe = torch.linspace(-3., 3., 13, dtype=func.lin1.weight.dtype, device=func.lin1.weight.device)
+    if torch.allclose(acts[0](probe), torch.sin(probe)):
+        return 'sin'
+    if torch.allclose(acts[0](probe), torch.tanh(probe)):
+        return 'tanh'
+    return None
+
+
+def _activation_jet(kind, z):
+    """
+    activation and its first two derivatives at z
+    """
+    if kind == 'sin':
+        s = torch.sin(z)
+        return s, torch.cos(z), -s
+    s = torch.tanh(z)
+    ds = 1 - s ** 2
+    return s, ds, -2 * s * ds
+
+
+def get_hidden_derivatives(func, inputs, partials=((0,),)):
+    """
+    hidden states and their partials for the two-layer ODEFunc (lin1 -> sin/tanh -> lin2 -> sin/tanh)
+
+    uses the chain rule in closed form, so everything comes out of one forward pass of a few matmuls
+    and no graph is built. inputs/partials follow get_derivatives and are ordered like the
+    columns lin1 sees. Other architectures or orders above two fall back to get_derivatives.
+    returns [H, *partials]
+    """
+    kind = _activation_kind(func)
+    partials = [tuple(p) for p in partials]
+    if kind is None or any(len(p) > 2 for p in partials):
+        fn = func.hidden_states if hasattr(func, 'hidden_states') else func.h
+        return get_derivatives(fn, inputs, partials, create_graph=False)
+
+    with torch.no_grad():
+        W1, W2 = func.lin1.weight, func.lin2.weight
+        s1, ds1, dds1 = _activation_jet(kind, func.lin1(torch.cat([x.reshape(-1, 1) for x in inputs], 1)))
+        H, ds2, dds2 = _activation_jet(kind, func.lin2(s1))
+
+        # z2_i = d(lin2 pre-activation)/d input_i, shared by every partial that needs it
+        z2 = {i: (ds1 * W1[:, i]) @ W2.t() for i in {i for p in partials for i in p}}
+        out = [H]
+        for p in partials:
+            if len(p) == 1:
+                out.append(ds2 * z2[p[0]])
+            else:
+                i, j = p
+                z2_ij = (dds1 * W1[:, i] * W1[:, j]) @ W2.t()
+                out.append(dds2 * z2[i] * z2[j] + ds2 * z2_ij)
+    return out
+
+
+
+def stream_normal_equations(func, inputs, operator, rhs, chunk_size=4096):
+    """
+    DH^T DH and DH^T rhs for DH = sum_k c_k d^(p_k) [H, 1] over every collocation point in inputs
+
+    the points are walked in chunks of chunk_size through get_hidden_derivatives without a graph and both
+    products are accumulated in place, so memory is O(H^2 + chunk_size H) however many points there are.
+    operator is a list of (c_k, p_k) with p_k a partial as in get_derivatives (() for H itself) and rhs
+    maps the chunked inputs to (n, K).
+    """
+    partials = [p for _, p in operator if len(p)]
+    LHS, RHS = None, None
+    for start in range(0, len(inputs[0]), chunk_size):
+        chunk = [x[start:start + chunk_size].detach() for x in inputs]
+        H, *derivs = get_hidden_derivatives(func, chunk, partials)
+        with torch.no_grad():
+            derivs = iter(derivs)
+            DH = 0
+            for c, p in operator:
+                if len(p):
+                    DH = DH + c * torch.cat([next(derivs), torch.zeros_like(H[:, :1])], 1)
+                else:
+                    DH = DH + c * torch.cat([H, torch.ones_like(H[:, :1])], 1)
+            f = rhs(*chunk)
+            if LHS is None:
+                LHS = DH.new_zeros(DH.shape[1], DH.shape[1])
+                RHS = DH.new_zeros(DH.shape[1], f.shape[1])
+            LHS.addmm_(DH.t(), DH)
+            RHS.addmm_(DH.t(), f)
+    return LHS, RHS
+
+
+class _AxisNet(nn.Module):
+    """
+    1D two-layer net (lin1 -> act -> lin2 -> act), so get_hidden_derivatives takes its closed form path
+    """
+
+    def __init__(self, hidden_dim, nl):
+        super(_AxisNet, self).__init__()
+        self.nl = nl
+        self.lin1 = nn.Linear(1, hidden_dim)
+        self.lin2 = nn.Linear(hidden_dim, hidden_dim)
+
+    def hidden_states(self, s):
+        return self.nl(self.lin2(self.nl(self.lin1(s.reshape(-1, 1)))))
+
+
+class SeparableODEFunc(nn.Module):
+    """
+    drop-in ODEFunc for the PDE scripts whose hidden states are products h(t, x) = h_t(t) * h_x(x) of two 1D nets
+
+    pointwise it trains and evaluates like the dense ODEFunc. On a tensor grid the hidden states (and their
+    partials) are row-wise Kronecker products of axis_features, so the grid costs Nt + Nx network evaluations
+    and the Wout Grams can be assembled with kron_gram / kron_rhs without ever forming the Nt Nx x H matrix.
+    """
+
+    def __init__(self, hidden_dim, output_dim, nl=None):
+        super(SeparableODEFunc, self).__init__()
+        self.hdim = hidden_dim
+        self.nl = nl if nl is not None else nn.Tanh()
+        self.net_t = _AxisNet(hidden_dim, self.nl)
+        self.net_x = _AxisNet(hidden_dim, self.nl)
+        self.lout = nn.Linear(self.hdim, output_dim, bias=True)
+
+    def hidden_states(self, t, x):
+        return self.net_t.hidden_states(t) * self.net_x.hidden_states(x)
+
+    def forward(self, t, x):
+        return self.lout(self.hidden_states(t, x))
+
+    def wouts(self, x):
+        return self.lout(x)
+
+    def axis_features(self, t, x, t_orders=(0,), x_orders=(0,)):
+        """
+        {order: [d^order h_t, c]} at the points t and likewise for x, with c = 1 for order 0 and 0 otherwise,
+        so that kron_rows of an order-0 pair gives the [H, 1] the Wout solves use
+        """
+        out = []
+        for net, s, orders in [(self.net_t, t, t_orders), (self.net_x, x, x_orders)]:
+            derivs = get_hidden_derivatives(net, (s.reshape(-1, 1),), [(0,) * k for k in orders if k])
+            h, derivs = derivs[0], iter(derivs[1:])
+            features = {}
+            for k in orders:
+                d = next(derivs) if k else h
+                features[k] = torch.cat([d, torch.full_like(d[:, :1], float(k == 0))], 1)
+            out.append(features)
+        return out
+
+
+def kron_rows(A, B):
+    """
+    rows A[i] * B[j] in the order of torch.meshgrid(a, b) raveled, i.e. (Na Nb, H)
+    """
+    return (A.unsqueeze(1) * B.unsqueeze(0)).reshape(-1, A.shape[1])
+
+
+def kron_gram(terms_a, terms_b=None):
+    """
+    Da^T Db for row-wise Kronecker operators D = sum_k c_k kron_rows(A_k, B_k) on a full tensor grid
+
+    the Gram of a row-wise Kronecker product is the Hadamard product of the factor Grams, so this costs
+    O(H^2 (Na + Nb)) per pair of terms instead of O(Na Nb H^2). terms are lists of (c_k, A_k, B_k).
+    """
+    terms_b = terms_a if terms_b is None else terms_b
+    G = 0
+    for (c1, A1, B1), (c2, A2, B2) in itertools.product(terms_a, terms_b):
+        G = G + c1 * c2 * (A1.t() @ A2) * (B1.t() @ B2)
+    return G
+
+
+def kron_rhs(terms, F):
+    """
+    D^T F for D as in kron_gram and F (Na, Nb, K) sampled on the same grid
+    """
+    R = 0
+    for c, A, B in terms:
+        R = R + c * torch.einsum('ih,ijk,jh->hk', A, F, B)
+    return R
+
+
+def kron_eval(A, B, W):
+    """
+    kron_rows(A, B) @ W as an (Na, Nb, K) grid, contracting the factors one at a time
+    """
+    return torch.einsum('ihk,jh->ijk', A.unsqueeze(2) * W.unsqueeze(0), B)
+
+
+
+class _Structured:
+    """
+    shared algebra of the structured operators: op + op sums lazily, op @ tensor applies without densifying
+    """
+
+    def __add__(self, other):
+        return OperatorSum([self, other])
+
+    def __sub__(self, other):
+        return OperatorSum([self, -1. * other])
+
+    def __rmul__(self, c):
+        return self._scaled(c)
+
+
+def to_dense(op):
+    return op.to_dense() if isinstance(op, _Structured) else op
+
+
+class ScaledIdentity(_Structured):
+    """
+    c I_n, kept as (n, c) so it costs nothing inside a Kron
+    """
+
+    def __init__(self, n, c=1., dtype=None, device=None):
+        self.n, self.c = n, c
+        self.dtype, self.device = dtype, device
+        self.shape = (n, n)
+
+    def _scaled(self, c):
+        return ScaledIdentity(self.n, c * self.c, self.dtype, self.device)
+
+    def t(self):
+        return self
+
+    def __matmul__(self, x):
+        if isinstance(x, ScaledIdentity):
+            return x._scaled(self.c)
+        return self.c * x
+
+    def to_dense(self):
+        return self.c * torch.eye(self.n, dtype=self.dtype, device=self.device)
+
+
+class Kron(_Structured):
+    """
+    A (x) B, block (i, j) is A[i, j] B; A is a small dense matrix, B a tensor or ScaledIdentity
+
+    Kron(I_k, B) is torch.block_diag(B, ..., B) and Kron(A, ScaledIdentity(n)) the A (x) I_n that mixes
+    the k copies, so (A (x) I_n) @ (I_k (x) B) = A (x) B never has to form the kn x kn matrix
+    """
+
+    def __init__(self, A, B):
+        self.A, self.B = A, B
+        self.shape = (A.shape[0] * B.shape[0], A.shape[1] * B.shape[1])
+
+    def _scaled(self, c):
+        return Kron(c * self.A, self.B)
+
+    def t(self):
+        return Kron(self.A.t(), self.B.t())
+
+    def __matmul__(self, x):
+        if isinstance(x, Kron):
+            return Kron(self.A @ x.A, self.B @ x.B)
+        if isinstance(x, _Structured):
+            return self @ x.to_dense()
+        X = x.reshape(self.A.shape[1], self.B.shape[1], -1)
+        BX = self.B @ X if isinstance(self.B, ScaledIdentity) else torch.matmul(self.B, X)
+        out = torch.einsum('ij,jnk->ink', self.A, BX)
+        return out.reshape(self.shape[0], *x.shape[1:])
+
+    def to_dense(self):
+        return torch.kron(self.A, to_dense(self.B))
+
+
+class BlockDiag(_Structured):
+    """
+    torch.block_diag(*blocks) for blocks of any shapes, applied block by block
+    """
+
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.shape = (sum(b.shape[0] for b in self.blocks), sum(b.shape[1] for b in self.blocks))
+
+    def _scaled(self, c):
+        return BlockDiag([c * b for b in self.blocks])
+
+    def t(self):
+        return BlockDiag([b.t() for b in self.blocks])
+
+    def __matmul__(self, x):
+        if isinstance(x, _Structured):
+            x = x.to_dense()
+        xs = torch.split(x, [b.shape[1] for b in self.blocks])
+        return torch.cat([b @ xi for b, xi in zip(self.blocks, xs)])
+
+    def to_dense(self):
+        return torch.block_diag(*[to_dense(b) for b in self.blocks])
+
+
+class OperatorSum(_Structured):
+    """
+    sum of structured operators (or tensors) of one shape
     """
-    # ones = torch.ones_like(u)
 
+    def __init__(self, terms):
+        self.terms = []
+        for term in terms:
+            self.terms += term.terms if isinstance(term, OperatorSum) else [term]
+        self.shape = tuple(self.terms[0].shape)
+
+    def _scaled(self, c):
+        return OperatorSum([c * term for term in self.terms])
+
+    def t(self):
+        return OperatorSum([term.t() for term in self.terms])
+
+    def __matmul__(self, x):
+        return sum(term @ x for term in self.terms)
+
+    def to_dense(self):
+        return sum(to_dense(term) for term in self.terms)
 
-    der = torch.cat([torch.autograd.grad(u[:, i].sum(), t, create_graph=True)[0] for i in range(u.shape[1])],1)
-    if der is None:
-        print('derivative is None')
-        return torch.zeros_like(t, requires_grad=True)
-    else:
-        der.requires_grad_()
-    for _ in range(1, order):
 
-        der = torch.cat([torch.autograd.grad(der[:, i].sum(), t, create_graph=True)[0] for i in range(der.shape[1])],1)
-        # print()
-        if der is None:
-            print('derivative is None')
-            return torch.zeros_like(t, requires_grad=True)
+def gram(a, b=None):
+    """
+    dense a^T b for structured operators, without forming the kN x kN mixing matrix (A (x) I)
+
+    Kron pairs use (A1 (x) B1)^T (A2 (x) B2) = A1^T A2 (x) B1^T B2 and BlockDiag pairs with matching blocks
+    stay block diagonal. Sums are not expanded: the terms of a PDE operator nearly cancel wherever the fit
+    is good, and squaring them separately loses that cancellation, so a sum is densified to its rows
+    (e.g. 2N x 2H, the size of the hidden states) and multiplied out.
+    anything else is a.t() applied to b.
+    """
+    b = a if b is None else b
+    if isinstance(a, OperatorSum) or isinstance(b, OperatorSum):
+        return to_dense(a).t() @ to_dense(b)
+    if isinstance(a, Kron) and isinstance(b, Kron):
+        return torch.kron(to_dense(gram(a.A, b.A)), to_dense(gram(a.B, b.B)))
+    if isinstance(a, BlockDiag) and isinstance(b, BlockDiag) and \
+            [blk.shape[0] for blk in a.blocks] == [blk.shape[0] for blk in b.blocks]:
+        return torch.block_diag(*[to_dense(gram(x, y)) for x, y in zip(a.blocks, b.blocks)])
+    if isinstance(a, ScaledIdentity):
+        return a.c * b
+    return a.t() @ b
+
+
+
+
+class LinearSolver:
+    """
+    factored normal equations LHS w = rhs of a Wout least-squares problem (LHS symmetric or, for complex
+    Wout, Hermitian positive semidefinite, a single H x H matrix or a batch of them)
+
+    method='auto' picks a path per system from a cheap condition estimate (power iterations on LHS and,
+    through its Cholesky factor, on LHS^-1): plain Cholesky below 1/sqrt(eps), otherwise Cholesky with
+    iterative refinement (residuals in float64). When Cholesky breaks down (the Grams are often numerically
+    indefinite, e.g. fewer collocation points than hidden units) it falls back to pivoted LU, or to an
+    eigh-truncated SVD if LU finds an exactly singular pivot. The SVD path can also be requested
+    explicitly; it is not picked otherwise because truncating the small directions costs accuracy in the
+    fit. from_rows(A) factors the rows themselves by QR instead, so only cond(A) enters.
+    The factorization is cached for repeated solves; method reports the path(s) that ran.
+    """
+
+    PATHS = ('cholesky', 'refine', 'svd', 'qr', 'lu')
+
+    def __init__(self, lhs, method='auto', rcond=None, refine_steps=2):
+        if method == 'qr':
+            raise ValueError('the qr path factors the rows, use LinearSolver.from_rows')
+        self.batched = lhs.dim() == 3
+        self.lhs = lhs if self.batched else lhs.unsqueeze(0)
+        self.refine_steps = refine_steps
+        eps = torch.finfo(lhs.dtype).eps
+        self.rcond = rcond or eps * lhs.shape[-1]
+
+        self.L, info = torch.linalg.cholesky_ex(self.lhs)
+        self.cond = self._condition_estimate(info)
+        if method == 'auto':
+            self.path = torch.where(self.cond < eps ** -0.5, 0, 1)
         else:
-            der.requires_grad_()
-    return der
+            self.path = torch.full_like(info, self.PATHS.index(method))
+        # LU for the requested systems and for those where Cholesky broke down; the factors are kept
+        # in path order, so they line up with the rows of path == 4
+        lu = (self.path == 4) | ((info > 0) & (self.path != 2))
+        if lu.any():
+            self.lu, self.pivots, lu_info = torch.linalg.lu_factor_ex(self.lhs[lu])
+            self.path[lu] = torch.where(lu_info == 0, 4, 2).to(self.path.dtype)
+            self.lu, self.pivots = self.lu[lu_info == 0], self.pivots[lu_info == 0]
+
+        svd = self.path == 2
+        if svd.any():
+            e, self.V = torch.linalg.eigh(self.lhs[svd])
+            cutoff = self.rcond * e.abs().max(1, keepdim=True).values
+            self.e_inv = torch.where(e > cutoff, 1 / e, torch.zeros_like(e))
+
+    def _condition_estimate(self, info, steps=3):
+        # a few power iterations for the largest eigenvalue and, through the factor, for the inverse's
+        # deterministic start so the estimate does not consume the seeded RNG
+        n = self.lhs.shape[1]
+        x = torch.linspace(1., 2., n, dtype=self.lhs.dtype, device=self.lhs.device).reshape(1, n, 1)
+        x = x.expand(len(self.lhs), n, 1)
+        y = x.clone()
+        for _ in range(steps):
+            x = self.lhs @ x
+            lam_max = torch.linalg.norm(x, dim=1)
+            x = x / lam_max.unsqueeze(1)
+            y = torch.cholesky_solve(y, self.L)
+            lam_inv = torch.linalg.norm(y, dim=1)
+            y = y / lam_inv.unsqueeze(1)
+        cond = (lam_max * lam_inv).reshape(-1)
+        cond[(info > 0) | ~torch.isfinite(cond)] = float('inf')
+        return cond
+
+    @classmethod
+    def from_rows(cls, A, method='auto', rcond=None):
+        """
+        least squares on the rows A (n x H) themselves: QR, or a truncated SVD of R when R is near singular
+        """
+        self = cls.__new__(cls)
+        self.batched = False
+        eps = torch.finfo(A.dtype).eps
+        self.rcond = rcond or eps * A.shape[1]
+        self.Q, self.R = torch.linalg.qr(A)
+        diag = self.R.diagonal().abs()
+        self.cond = (diag.max() / diag.min().clamp_min(torch.finfo(A.dtype).tiny)).reshape(1)
+        if method == 'auto':
+            method = 'qr' if self.cond < 1e-2 / eps else 'svd'
+        self.path = torch.full((1,), cls.PATHS.index(method))
+        if method == 'svd':
+            self.U, sv, Vh = torch.linalg.svd(self.R)
+            self.sv_inv = torch.where(sv > self.rcond * sv[0], 1 / sv, torch.zeros_like(sv))
+            self.V = Vh.mH
+        return self
+
+    @property
+    def method(self):
+        return '+'.join(self.PATHS[i] for i in sorted(set(self.path.tolist())))
+
+    def solve_rows(self, b):
+        """
+        argmin ||A w - b|| for a solver built with from_rows
+        """
+        c = self.Q.mH @ b
+        if self.path[0] == 3:
+            return torch.linalg.solve_triangular(self.R, c, upper=True)
+        return self.V @ (self.sv_inv.reshape(-1, 1) * (self.U.mH @ c))
+
+    def solve(self, rhs):
+        """
+        w with LHS w = rhs, rhs (H, K) or (B, H, K) for a batch
+        """
+        if hasattr(self, 'R'):
+            if self.path[0] == 3:
+                y = torch.linalg.solve_triangular(self.R.mH, rhs, upper=False)
+                return torch.linalg.solve_triangular(self.R, y, upper=True)
+            return self.V @ (self.sv_inv.reshape(-1, 1) ** 2 * (self.V.mH @ rhs))
+
+        rhs = rhs if rhs.dim() == 3 else rhs.unsqueeze(0)
+        rhs = rhs.expand(len(self.lhs), *rhs.shape[1:])
+        W = torch.empty_like(rhs)
+        chol, refine, svd, lu = self.path <= 1, self.path == 1, self.path == 2, self.path == 4
+        if chol.any():
+            W[chol] = torch.cholesky_solve(rhs[chol], self.L[chol])
+        if refine.any():
+            wide = torch.complex128 if rhs.is_complex() else torch.float64
+            lhs, L, r0 = self.lhs[refine].to(wide), self.L[refine], rhs[refine].to(wide)
+            w = W[refine].to(wide)
+            for _ in range(self.refine_steps):
+                w = w + torch.cholesky_solve((r0 - lhs @ w).to(rhs.dtype), L).to(wide)
+            W[refine] = w.to(rhs.dtype)
+        if lu.any():
+            W[lu] = torch.linalg.lu_solve(self.lu, self.pivots, rhs[lu])
+        if svd.any():
+            W[svd] = self.V @ (self.e_inv.unsqueeze(2) * (self.V.mH @ rhs[svd]))
+        return W if self.batched else W[0]
+
+
+def gaussian_sketch(A, m):
+    """
+    S A for a dense Gaussian S (m x n) scaled so that E[S^T S] = I
+    """
+    S = torch.randn(m, len(A), dtype=A.dtype, device=A.device) / m ** 0.5
+    return S @ A
+
+
+def count_sketch(A, m):
+    """
+    S A for a CountSketch S (m x n): every row of A is added with a random sign to one random output row, O(nnz(A))
+    """
+    buckets = torch.randint(m, (len(A),), device=A.device)
+    signs = torch.randint(2, (len(A), 1), device=A.device).to(A.dtype) * 2 - 1
+    return A.new_zeros(m, *A.shape[1:]).index_add_(0, buckets, signs * A)
+
+
+def leverage_scores(A, sketch_size=None, jl_dim=32):
+    """
+    approximate leverage scores of the rows of A (n x d)
+
+    the SVD of a CountSketch of A gives a preconditioner P (directions with negligible singular values are
+    dropped, so rank-deficient blocks are fine) for which A P has nearly orthonormal columns; the squared
+    row norms of A P G, G a jl_dim Gaussian projection, then estimate the scores in O(nd (jl_dim + 1)).
+    """
+    d = A.shape[1]
+    _, sv, Vh = torch.linalg.svd(count_sketch(A, sketch_size or 4 * d), full_matrices=False)
+    keep = sv > sv[0] * torch.finfo(A.dtype).eps * d
+    P = Vh[keep].mH / sv[keep]
+    if jl_dim is not None and jl_dim < P.shape[1]:
+        P = P @ torch.randn(P.shape[1], jl_dim, dtype=A.dtype, device=A.device) / jl_dim ** 0.5
+    return ((A @ P).abs() ** 2).sum(1)
+
+
+def sketch_rows(A, b, m, method='leverage', scores=None):
+    """
+    m-row surrogate (S A, S b) of the least-squares block (A, b) with E[(SA)^T SA] = A^T A
+
+    method is uniform or leverage (rows drawn with replacement, reweighted by 1 / sqrt(m p_i)), or a
+    gaussian/countsketch projection. scores can pass precomputed leverage scores.
+    """
+    n = len(A)
+    if method in ('uniform', 'leverage'):
+        if method == 'uniform':
+            p = A.real.new_full((n,), 1 / n)
+        else:
+            p = leverage_scores(A) if scores is None else scores
+            p = p / p.sum()
+        idx = torch.multinomial(p, m, replacement=True)
+        w = (1 / (m * p[idx])).sqrt().reshape(-1, 1)
+        return w * A[idx], w * b[idx]
+    sketch = {'gaussian': gaussian_sketch, 'countsketch': count_sketch}[method]
+    SAb = sketch(torch.cat([A, b], 1), m)
+    return SAb[:, :A.shape[1]], SAb[:, A.shape[1]:]
+
+
+def fewest_rows(A, b, solve, target, method='leverage', m0=64, growth=2.):
+    """
+    smallest sketch size (grown geometrically from m0) whose solution meets target on the full block
+
+    solve maps a sketched block (SA, Sb) to the solution w; the error is the mean squared residual of A w - b.
+    returns SA, Sb, w and the error
+    """
+    scores = leverage_scores(A) if method == 'leverage' else None
+    m = m0
+    while True:
+        SA, Sb = sketch_rows(A, b, m, method, scores)
+        w = solve(SA, Sb)
+        error = ((A @ w - b).abs() ** 2).mean().item()
+        if error <= target or m >= len(A):
+            return SA, Sb, w, error
+        m = min(int(m * growth), len(A))
+
+
+def sketch_tradeoff(A, b, solve, sizes, method='leverage', repeats=3):
+    """
+    mean squared residual on the full block and wall time of the sketched solve for every size in sizes
+    returns a list of (size, error, seconds) averaged over repeats
+    """
+    scores = leverage_scores(A) if method == 'leverage' else None
+    out = []
+    for m in sizes:
+        errors, s1 = [], time.time()
+        for _ in range(repeats):
+            w = solve(*sketch_rows(A, b, m, method, scores))
+            errors.append(((A @ w - b).abs() ** 2).mean().item())
+        out.append((m, sum(errors) / repeats, (time.time() - s1) / repeats))
+    return out
+
+
+def tiled_column_stats(prediction, truth, n_rows, n_cols, max_bytes=2 ** 28, bytes_per_entry=64):
+    """
+    per-column max and mean over rows of (truth - prediction)^2, without the n_rows x n_cols matrices
+
+    prediction(rows, cols) and truth(rows, cols) return (len(rows), len(cols)) tiles for the slices rows, cols.
+    tiles are as many whole columns as fit in max_bytes (bytes_per_entry covers every temporary of one entry,
+    e.g. complex prediction, its modulus, the truth and the difference), so each is one GEMM plus a reduction;
+    when a single column does not fit the rows are tiled too.
+    returns (max, mean), each (n_cols,)
+    """
+    entries = max(1, max_bytes // bytes_per_entry)
+    col_block = min(n_cols, max(1, entries // n_rows))
+    row_block = min(n_rows, entries // col_block)
+    maxs, means = [], []
+    for c in range(0, n_cols, col_block):
+        cols = slice(c, min(c + col_block, n_cols))
+        tile_max, tile_sum = None, 0.
+        for r in range(0, n_rows, row_block):
+            rows = slice(r, min(r + row_block, n_rows))
+            err = (truth(rows, cols) - prediction(rows, cols)) ** 2
+            tile_max = err.max(0).values if tile_max is None else torch.maximum(tile_max, err.max(0).values)
+            tile_sum = tile_sum + err.sum(0)
+        maxs.append(tile_max)
+        means.append(tile_sum / n_rows)
+    return torch.cat(maxs), torch.cat(means)
+
+
+def chain_windows(solve_window, state, n_windows):
+    """
+    trajectory over n_windows consecutive time windows of one trained basis
+
+    solve_window(state) solves one window from its initial state and returns its trajectory (time first,
+    a tensor or a tuple of tensors) and its state at the window end, the next window's initial state.
+    the first sample of a window repeats the last one of the window before, so only the earlier one is
+    kept; how far the two disagree (the ICs are imposed in the least-squares sense) is returned as jumps.
+    the cost is n_windows window solves.
+    returns the concatenated trajectory, the final state and the max abs jump at each window boundary
+    """
+    segments, jumps = [], []
+    for k in range(n_windows):
+        segment, state = solve_window(state)
+        segment = segment if isinstance(segment, tuple) else (segment,)
+        if k > 0:
+            jumps.append(max((s[0] - p[-1]).abs().max().item() for s, p in zip(segment, segments[-1])))
+        segments.append(segment)
+    out = tuple(torch.cat([seg[0]] + [s[1:] for s in seg[1:]]) for seg in zip(*segments))
+    return out if len(out) > 1 else out[0], state, jumps
+
+
+class WeightedGram:
+    """
+    Grams of DH = sum_m c_m(t) S_m weighted by a fixed function dictionary phi_k(t) on the time grid
+
+    with c_m = sum_k alpha_mk phi_k and f = sum_k gamma_k phi_k, DH^T DH and DH^T f are contractions of
+    alpha/gamma with S_m^T diag(phi_k phi_l) S_n and S_m^T (phi_k phi_l), precomputed once per trained
+    basis, so assembling Wout no longer depends on the length of the time grid.
+    """
+
+    def __init__(self, bases, phis):
+        S = torch.stack(bases)
+        pairs = (phis[:, :, None] * phis[:, None, :]).reshape(len(phis), -1)
+        self.M, self.K, self.H = S.shape[0], phis.shape[1], S.shape[2]
+        self.G = torch.einsum('mti,tp,ntj->mnpij', S, pairs, S).reshape(-1, self.H * self.H)
+        self.g = torch.einsum('mti,tp->mpi', S, pairs).reshape(-1, self.H)
+
+    def normal_equations(self, alphas, gammas):
+        """
+        alphas (N, M, K) and gammas (N, K) hold the dictionary coefficients of every c_m and f per bundle
+        returns DH^T DH (N, H, H) and DH^T f (N, H)
+        """
+        N = len(alphas)
+        P = torch.einsum('bmk,bnl->bmnkl', alphas, alphas).reshape(N, -1)
+        Q = torch.einsum('bmk,bl->bmkl', alphas, gammas).reshape(N, -1)
+        return (P @ self.G).reshape(N, self.H, self.H), Q @ self.g
+
+
+
+class WoutCache:
+    """
+    LRU cache of solved Wouts indexed by their initial condition/parameter vector, used to warm-start
+    nonlinear solves for nearby queries
+
+    keys are hashed into a grid of cell_size cells; a lookup searches the query's cell and its neighbours
+    and returns the exact match, or the inverse-distance weighted mean of the n_neighbours closest entries.
+    """
+
+    def __init__(self, cell_size, max_size=1024, n_neighbours=4):
+        self.cell_size = cell_size
+        self.max_size = max_size
+        self.n_neighbours = n_neighbours
+        self.entries = OrderedDict()
+        self.grid = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cell(self, key):
+        return tuple(int(c) for c in torch.floor(key / self.cell_size).tolist())
+
+    def put(self, key, wout):
+        key = key.detach().reshape(-1).double()
+        k = tuple(key.tolist())
+        if k in self.entries:
+            self.entries.move_to_end(k)
+        else:
+            self.grid.setdefault(self._cell(key), set()).add(k)
+        self.entries[k] = (key, wout.detach().clone())
+        while len(self.entries) > self.max_size:
+            old, (old_key, _) = self.entries.popitem(last=False)
+            cell = self._cell(old_key)
+            self.grid[cell].discard(old)
+            if not self.grid[cell]:
+                del self.grid[cell]
+
+    def get(self, key):
+        """
+        warm-start Wout for key, or None when no entry lies in a neighbouring cell
+        """
+        key = key.detach().reshape(-1).double()
+        cell = self._cell(key)
+        found = []
+        for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+            found.extend(self.grid.get(tuple(c + o for c, o in zip(cell, offset)), ()))
+        if not found:
+            self.misses += 1
+            return None
+        self.hits += 1
+        dists = torch.stack([torch.linalg.norm(self.entries[k][0] - key) for k in found])
+        dists, order = torch.sort(dists)
+        nearest = [found[i] for i in order[:self.n_neighbours].tolist()]
+        for k in nearest:
+            self.entries.move_to_end(k)
+        if dists[0] == 0:
+            return self.entries[nearest[0]][1].clone()
+        weights = 1 / dists[:len(nearest)]
+        weights = weights / weights.sum()
+        wouts = torch.stack([self.entries[k][1] for k in nearest])
+        return (weights.to(wouts.dtype).reshape(-1, *[1] * (wouts.dim() - 1)) * wouts).sum(0)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _code_content(code):
+    consts = tuple(_code_content(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts)
+    return 'code', code.co_code.hex(), consts, code.co_names
+
+
+def _global_names(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= _global_names(c)
+    return names
+
+
+def _content(obj, _active=None):
+    """
+    reproducible description of a parameter for hashing: tensors by their bytes, functions by their code
+    together with their defaults, closure cells and the globals they reference (modules by name).
+    anything else is described by repr; objects with the default repr (an address) cannot be content
+    addressed and raise TypeError rather than getting a key that is not their content
+    """
+    if isinstance(obj, types.ModuleType):
+        return 'module', obj.__name__
+    if isinstance(obj, types.FunctionType):
+        active = _active or set()
+        if id(obj) in active:
+            return 'recursive', obj.__qualname__
+        active = active | {id(obj)}
+        code = obj.__code__
+        closure = tuple(_content(cell.cell_contents, active) for cell in obj.__closure__ or ())
+        globs = tuple((name, _content(obj.__globals__[name], active))
+                      for name in sorted(_global_names(code)) if name in obj.__globals__)
+        return ('fn', _code_content(code), _content(obj.__defaults__, active),
+                _content(sorted((obj.__kwdefaults__ or {}).items()), active), closure, globs)
+    if torch.is_tensor(obj):
+        return 'tensor', str(obj.dtype), tuple(obj.shape), obj.detach().cpu().numpy().tobytes().hex()
+    if isinstance(obj, (tuple, list)):
+        return tuple(_content(o, _active) for o in obj)
+    if isinstance(obj, dict):
+        return 'dict', tuple((repr(k), _content(v, _active)) for k, v in obj.items())
+    if type(obj).__repr__ is object.__repr__:
+        raise TypeError(f'cannot content-address {type(obj).__name__} objects for the trajectory cache')
+    return repr(obj)
+
+
+class TrajectoryCache:
+    """
+    content-addressed on-disk cache of reference trajectories
+
+    a bundle's key is the sha256 of its equation family, parameter tuple (see _content), initial state,
+    time grid and solver settings. each batch of misses is stored as one (T, n, D) .npy file and hits are
+    read back memory-mapped, one file at a time; files are touched when read and, after every store, the
+    least recently used ones are evicted until the cache holds at most max_bytes; a batch larger than
+    max_bytes on its own is solved but not stored.
+    adaptive solvers pick their steps for the whole batch, so a cached trajectory agrees with the one a
+    different batch would give to the solver tolerance, not bit for bit
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.hits = 0
+        self.misses = 0
+        self.elapsed = None
+
+    def keys(self, family, params, y0, t, settings=()):
+        shared = hashlib.sha256(repr((family, settings, str(y0.dtype), tuple(y0.shape[1:]))).encode())
+        shared.update(t.detach().cpu().numpy().tobytes())
+        keys = []
+        for p, y in zip(params, y0.detach().cpu().numpy()):
+            h = shared.copy()
+            h.update(repr(_content(p)).encode())
+            h.update(y.tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def get_solution(self, family, make_diffeq, params, y0, t, **solver):
+        """
+        trajectories (T x B x D) of the bundles with parameter tuples params (B) and initial states y0 (B x D)
+
+        hits are read from disk and only the misses are integrated, as one batch, by
+        base_diffeq(make_diffeq(their params), **solver); the wall time of the lookup is kept in elapsed
+        """
+        s1 = time.time()
+        t = t.detach()
+        probe = base_diffeq(None, **solver)
+        keys = self.keys(family, params, y0, t, (probe.backend, probe.method, probe.rtol, probe.atol, probe.substeps))
+        out = torch.empty(len(t), *y0.shape, dtype=y0.dtype, device=y0.device)
+        found = self._read(keys, out)
+        miss = [i for i, hit in enumerate(found) if not hit]
+        if miss:
+            out[:, miss] = base_diffeq(make_diffeq([params[i] for i in miss]), **solver).get_solution(y0[miss], t)
+            self._write([keys[i] for i in miss], out[:, miss])
+        self.hits += len(keys) - len(miss)
+        self.misses += len(miss)
+        self.elapsed = time.time() - s1
+        return out
+
+    def _read(self, keys, out):
+        found = [False] * len(keys)
+        files = {}
+        for i, k in enumerate(keys):
+            if k in self.index:
+                name, col = self.index[k]
+                files.setdefault(name, []).append((i, col))
+        for name, entries in files.items():
+            path = os.path.join(self.dir, name)
+            if not os.path.exists(path):
+                continue
+            rows, cols = zip(*entries)
+            table = np.load(path, mmap_mode='r')
+            out[:, list(rows)] = torch.as_tensor(np.array(table[:, list(cols)]), dtype=out.dtype, device=out.device)
+            os.utime(path)
+            for i in rows:
+                found[i] = True
+        return found
+
+    def _write(self, keys, trajectories):
+        if trajectories.nbytes > self.max_bytes:
+            warnings.warn(f'{trajectories.nbytes} bytes of trajectories exceed the cache bound of {self.max_bytes}, not cached')
+            return
+        name = hashlib.sha256(''.join(keys).encode()).hexdigest() + '.npy'
+        path = os.path.join(self.dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, trajectories.cpu().numpy())
+        os.replace(path + '.tmp', path)
+        for col, k in enumerate(keys):
+            self.index[k] = [name, col]
+        self._evict()
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def _evict(self):
+        files = []
+        for name in set(name for name, _ in self.index.values()):
+            path = os.path.join(self.dir, name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, name))
+        kept, total = set(), 0
+        for _, size, name in sorted(files, reverse=True):
+            total += size
+            if total > self.max_bytes:
+                os.remove(os.path.join(self.dir, name))
+            else:
+                kept.add(name)
+        self.index = {k: v for k, v in self.index.items() if v[0] in kept}
+
+
+class LambdaSweep:
+    """
+    solves Q(lam) w = b with symmetric Q(lam) = P0 + lam P1 + lam^2 P2, P0 positive (semi)definite, for many lam
+
+    P0 = U diag(e) U^T whitens the problem to A0 + lam A1 + lam^2 A2, with e clamped from below so A0 = I except
+    in the (near) null directions of P0, where it is taken as I. With v = lam y it is linear in lam:
+    (I + lam G) [y; v] = [S b; 0] with G = [[A1, A2], [-I, 0]], and G = V diag(d) V^-1 is diagonalized once, after
+    which every lam costs O(H^2): y = V_top diag(1 / (1 + lam d)) V^-1 [...].
+    Everything is kept in float64; solutions whose relative residual exceeds tol or is not finite (e.g. the
+    null directions above, or 1 + lam d ~ 0) are redone with a direct solve.
+    """
+
+    def __init__(self, P0, P1, P2, tol=1e-6):
+        self.P = tuple(P.double() for P in (P0, P1, P2))
+        self.tol = tol
+        self.H = len(P0)
+        e, U = torch.linalg.eigh(self.P[0])
+        e_clamped = e.clamp_min(e.max() * 1e-14)
+        self.S = U.t() / e_clamped.sqrt().reshape(-1, 1)
+        A1, A2 = [self.S @ P @ self.S.t() for P in self.P[1:]]
+        I = torch.eye(self.H, dtype=A1.dtype, device=A1.device)
+        self.d, V = torch.linalg.eig(torch.cat([torch.cat([A1, A2], 1), torch.cat([-I, torch.zeros_like(I)], 1)]))
+        self.V_top = V[:self.H]
+        self.V_lu = torch.linalg.lu_factor(V)
+        self.fallbacks = 0
+
+    def lhs(self, lam):
+        return self.P[0] + lam * self.P[1] + lam ** 2 * self.P[2]
+
+    def solve(self, lams, rhs):
+        """
+        lams (L,), rhs (H, K) -> solutions (L, H, K)
+        """
+        dtype, rhs = rhs.dtype, rhs.double()
+        lams = torch.as_tensor(lams, dtype=rhs.dtype, device=rhs.device).reshape(-1)
+        b = torch.cat([self.S @ rhs, torch.zeros_like(rhs)])
+        c = torch.linalg.lu_solve(*self.V_lu, b.to(self.V_top.dtype))
+        scale = 1 / (1 + lams.reshape(-1, 1) * self.d.reshape(1, -1))
+        W = self.S.t() @ (self.V_top @ (scale.unsqueeze(2) * c)).real
 
+        L = lams.reshape(-1, 1, 1)
+        QW = self.P[0] @ W + L * (self.P[1] @ W) + L ** 2 * (self.P[2] @ W)
+        err = torch.linalg.norm(QW - rhs, dim=(1, 2)) / torch.linalg.norm(rhs).clamp_min(1e-300)
+        bad = ~(err <= self.tol)
+        self.fallbacks = int(bad.sum())
+        if self.fallbacks:
+            W[bad] = LinearSolver(torch.stack([self.lhs(lam) for lam in lams[bad]])).solve(rhs)
+        return W.to(dtype)
 
 
 class Transformer_Learned(nn.Module):